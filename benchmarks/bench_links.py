@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import time
+
+from chandl.parser import ThreadParser, parse_html, select_html_parsers
+
+from .synthetic import fourchan_thread
+
+URL = 'http://boards.4chan.org/g/thread/39894014'
+
+# The link patterns and loop used before links were dispatched by tag and attribute
+LEGACY_LINK_PATTERNS = [
+	re.compile('link.href'),
+	re.compile('script.src'),
+	re.compile('a.href'),
+	re.compile('img.src'),
+]
+
+def legacy_find_links(parser, soup):
+	for tag in soup.find_all(True):
+		for name, values in tag.attrs.items():
+			if isinstance(values, basestring):
+				values = [values]
+			for v in values:
+				matched = False
+
+				matchstr = u'{tag:s}.{attr:s}={value:s}'.format(tag = tag.name, attr = name, value = v)
+
+				for p in LEGACY_LINK_PATTERNS:
+					if p.match(matchstr) != None:
+						matched = True
+						break
+
+				if not matched:
+					continue
+
+				newvalue = parser._handle(v)
+				if newvalue != None:
+					tag[name] = newvalue
+
+	parser.postprocessor.process_new_posts([soup])
+
+def dispatch_find_links(parser, soup):
+	parser._find_links(soup)
+
+def bench(find_links, html, repeat):
+	best = None
+	for i in range(repeat):
+		soup = parse_html(html, select_html_parsers(html))
+		parser = ThreadParser(URL)
+
+		start = time.time()
+		find_links(parser, soup)
+		elapsed = time.time() - start
+
+		if best == None or elapsed < best:
+			best = elapsed
+
+	return best, str(soup)
+
+def main():
+	repeat = 3
+
+	for replies in (1000, 5000):
+		html = fourchan_thread(replies)
+
+		legacy, legacy_output = bench(legacy_find_links, html, repeat)
+		dispatch, dispatch_output = bench(dispatch_find_links, html, repeat)
+
+		print "{0:5d} replies: legacy {1:.3f}s, dispatch {2:.3f}s ({3:.1f}x) {4:s}".format(replies, legacy, dispatch, legacy / dispatch, "identical" if legacy_output == dispatch_output else "DIFFERENT")
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
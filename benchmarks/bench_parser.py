@@ -0,0 +1,62 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+from chandl.parser import HTML5LibBackend, LXMLBackend, PythonHTMLParserBackend, parse_html, select_html_parsers
+
+from .synthetic import fourchan_thread
+
+class AutoBackend(object):
+	# Automatic selection, including the cost of validating the result
+	name = 'auto'
+
+	def available(self):
+		return True
+
+	def parse(self, html):
+		return parse_html(html, select_html_parsers(html))
+
+BACKENDS = [
+	HTML5LibBackend(),
+	LXMLBackend(),
+	PythonHTMLParserBackend(),
+	AutoBackend(),
+]
+
+def bench(backend, html, repeat):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		soup = backend.parse(html)
+		elapsed = time.time() - start
+
+		if best == None or elapsed < best:
+			best = elapsed
+
+	return best, str(soup)
+
+def main():
+	repeat = 3
+
+	for replies in (0, 100, 1000):
+		html = fourchan_thread(replies)
+		reference = None
+
+		for backend in BACKENDS:
+			if not backend.available():
+				print "{0:>12s} not available".format(backend.name)
+				continue
+
+			elapsed, output = bench(backend, html, repeat)
+
+			if reference == None:
+				reference = output
+
+			print "{0:>12s} {1:5d} replies {2:8d} bytes {3:8.3f}s {4:s}".format(backend.name, replies, len(html), elapsed, "identical" if output == reference else "DIFFERENT")
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from email.utils import formatdate
+from urlparse import urlparse
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class ChanRequestHandler(BaseHTTPRequestHandler):
+	# Keep connections alive, like a real chan would
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		chan = self.server.chan
+		chan.requests += 1
+
+		# Requests arrive with the full URL, as the server is used as a proxy for every host
+		url = self.path
+		if not url.startswith('http'):
+			url = 'http://{0:s}{1:s}'.format(self.headers.get('Host', ''), self.path)
+
+		if chan.latency > 0:
+			time.sleep(chan.latency)
+
+		headers = {}
+
+		if url in chan.pages:
+			body, last_modified = chan.pages[url]
+			headers['Last-Modified'] = last_modified
+
+			if self.headers.get('If-Modified-Since') == last_modified:
+				self._respond(304, headers, '')
+				return
+		elif '.' in urlparse(url).path.rsplit('/', 1)[-1]:
+			body = chan.media(url)
+		else:
+			self._respond(404, headers, '')
+			return
+
+		self._respond(200, headers, body)
+
+	def _respond(self, code, headers, body):
+		chan = self.server.chan
+
+		self.send_response(code)
+		for name, value in headers.items():
+			self.send_header(name, value)
+
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+
+		# Send the body in chunks, sleeping as needed to stay within the bandwidth limit
+		chunk_size = 16384
+		for i in range(0, len(body), chunk_size):
+			chunk = body[i:i + chunk_size]
+			self.wfile.write(chunk)
+			chan.sent += len(chunk)
+
+			if chan.bandwidth != None:
+				time.sleep(float(len(chunk)) / chan.bandwidth)
+
+class ChanServer(object):
+	# A local stand-in for a chan, serving thread pages and generated media for any host
+	# Clients use it as their HTTP proxy, so thread and file URLs can be left as they are
+
+	def __init__(self, latency=0, bandwidth=None, media_size=(1024, 65536)):
+		# Seconds to wait before each response, and bytes per second per connection (None = unlimited)
+		self.latency = latency
+		self.bandwidth = bandwidth
+
+		# Range of sizes of generated media files
+		self.media_size = media_size
+
+		# Thread pages as (body, last modified) by URL
+		self.pages = {}
+		self._modified = 1400000000
+
+		self.requests = 0
+		self.sent = 0
+
+		self._server = None
+		self._thread = None
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:{0:d}'.format(self._server.server_address[1])
+
+	@property
+	def proxies(self):
+		return {'http' : self.url}
+
+	def set_page(self, url, body):
+		# Every update is a minute later than the last one, so If-Modified-Since works without waiting
+		self._modified += 60
+		self.pages[url] = (body, formatdate(self._modified, usegmt = True))
+
+	def media(self, url):
+		# Generate the same content for the same URL every time
+		digest = hashlib.md5(url).digest()
+		low, high = self.media_size
+		size = low + int(digest[:4].encode('hex'), 16) % (high - low + 1)
+
+		return (digest * (size // len(digest) + 1))[:size]
+
+	def start(self):
+		self._server = ThreadingHTTPServer(('127.0.0.1', 0), ChanRequestHandler)
+		self._server.chan = self
+
+		self._thread = threading.Thread(target = self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+		self._thread.join()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
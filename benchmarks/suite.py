@@ -0,0 +1,258 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+
+from chandl import ThreadDownloader, ThreadParser, PooledSession, Metrics
+
+from .synthetic import THREADS
+from .server import ChanServer
+
+def best_of(repeat, setup, run):
+	# Run setup() and then run() on its result, and return the best time of run()
+	best = None
+	for i in range(repeat):
+		args = setup()
+
+		start = time.time()
+		run(*args)
+		elapsed = time.time() - start
+
+		if best == None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def write_file(filename, data):
+	with open(filename, 'wb') as f:
+		f.write(data)
+
+def bench_parse(workdir, site, replies, opts):
+	url, thread = THREADS[site]
+	html = thread(replies)
+
+	seconds = best_of(opts.repeat, lambda: (ThreadParser(url),), lambda parser: parser._parse_html(html))
+	return { 'seconds' : seconds, 'bytes' : len(html) }
+
+def bench_find_links(workdir, site, replies, opts):
+	url, thread = THREADS[site]
+	html = thread(replies)
+
+	def setup():
+		parser = ThreadParser(url)
+		return parser, parser._parse_html(html)
+
+	seconds = best_of(opts.repeat, setup, lambda parser, soup: parser._find_links(soup))
+	return { 'seconds' : seconds, 'bytes' : len(html) }
+
+def saved_parser(workdir, site, replies):
+	# Return a parser with a saved thread loaded, as it would be when checking the thread again
+	url, thread = THREADS[site]
+
+	original = os.path.join(workdir, 'thread.original')
+	saved = os.path.join(workdir, 'thread.html')
+
+	write_file(original, thread(replies))
+
+	parser = ThreadParser(url)
+	parser.update(original)
+	parser.save(saved)
+
+	return ThreadParser(url, saved, board_type = parser.board_type)
+
+def bench_merge(workdir, site, replies, opts):
+	url, thread = THREADS[site]
+	html = thread(replies + opts.growth)
+
+	def setup():
+		parser = saved_parser(workdir, site, replies)
+		return parser, parser._parse_html(html)
+
+	seconds = best_of(opts.repeat, setup, lambda parser, soup: parser._merge(soup))
+	return { 'seconds' : seconds, 'new_posts' : opts.growth }
+
+def bench_update(workdir, site, replies, opts):
+	# Merging a new page including everything it takes - locating, parsing and merging the new posts, and scanning their links
+	url, thread = THREADS[site]
+
+	newfile = os.path.join(workdir, 'thread.new')
+	write_file(newfile, thread(replies + opts.growth))
+
+	def setup():
+		parser = saved_parser(workdir, site, replies)
+		parser._document()
+		return parser,
+
+	seconds = best_of(opts.repeat, setup, lambda parser: parser.update(newfile))
+	return { 'seconds' : seconds, 'new_posts' : opts.growth }
+
+def bench_save(workdir, site, replies, opts, incremental):
+	url, thread = THREADS[site]
+
+	newfile = os.path.join(workdir, 'thread.new')
+	write_file(newfile, thread(replies + opts.growth))
+
+	saved = os.path.join(workdir, 'thread.html')
+
+	def setup():
+		parser = saved_parser(workdir, site, replies)
+		parser.incremental_save = incremental
+		parser.update(newfile)
+		return parser,
+
+	seconds = best_of(opts.repeat, setup, lambda parser: parser.save(saved))
+	return { 'seconds' : seconds, 'bytes' : os.path.getsize(saved) }
+
+def bench_save_full(workdir, site, replies, opts):
+	return bench_save(workdir, site, replies, opts, False)
+
+def bench_save_incremental(workdir, site, replies, opts):
+	return bench_save(workdir, site, replies, opts, True)
+
+def bench_download(workdir, site, replies, opts):
+	# Download a thread from the local server, and then check it while it grows
+	url, thread = THREADS[site]
+
+	with ChanServer(latency = opts.latency, bandwidth = opts.bandwidth) as chan:
+		session = PooledSession(pool_maxsize = opts.workers)
+		session.proxies = chan.proxies
+
+		metrics = Metrics()
+
+		downloader = ThreadDownloader(url, workdir, None, session = session)
+		downloader.workers = opts.workers
+		downloader.metrics = metrics
+
+		chan.set_page(url, thread(replies))
+
+		start = time.time()
+		downloader.download()
+		initial = time.time() - start
+
+		polls = []
+		for i in range(opts.polls):
+			chan.set_page(url, thread(replies + opts.growth * (i + 1)))
+
+			start = time.time()
+			downloader.download()
+			polls.append(time.time() - start)
+
+		seconds = initial + sum(polls)
+
+		return {
+			'seconds' : seconds,
+			'initial_seconds' : initial,
+			'poll_seconds' : polls,
+			'bytes' : chan.sent,
+			'requests' : chan.requests,
+			'files' : metrics.counters.get('files', 0),
+			'bytes_per_second' : chan.sent / seconds if seconds > 0 else None,
+			'phases' : dict((phase, total) for phase, (count, total) in metrics.phases.items()),
+		}
+
+BENCHMARKS = [
+	('parse', bench_parse),
+	('find_links', bench_find_links),
+	('merge', bench_merge),
+	('update', bench_update),
+	('save_full', bench_save_full),
+	('save_incremental', bench_save_incremental),
+	('download', bench_download),
+]
+
+def run_case(queue, func, site, replies, opts):
+	workdir = tempfile.mkdtemp(prefix = 'chandl-bench-')
+
+	try:
+		result = func(workdir, site, replies, opts)
+
+		# Peak resident memory of this process, which ran only this case (kilobytes on Linux, bytes on OS X)
+		result['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		queue.put(result)
+	except Exception as e:
+		queue.put({ 'error' : repr(e) })
+	finally:
+		shutil.rmtree(workdir, ignore_errors = True)
+
+def measure(func, site, replies, opts):
+	# Run each case in its own process, so its peak memory usage can be measured
+	queue = multiprocessing.Queue()
+
+	p = multiprocessing.Process(target = run_case, args = (queue, func, site, replies, opts))
+	p.start()
+	result = queue.get()
+	p.join()
+
+	return result
+
+def parse_list(text):
+	return [s.strip() for s in text.split(',') if len(s.strip()) > 0]
+
+def main():
+	op = OptionParser(usage = "python -m benchmarks.suite [options]")
+	op.add_option('-o', '--output', dest = 'output', default = None,
+		help = "write results to this file as JSON (default: standard output)")
+	op.add_option('-s', '--sites', dest = 'sites', default = ','.join(THREADS),
+		help = "comma-separated list of board types to generate threads for (default: all)")
+	op.add_option('-b', '--benchmarks', dest = 'benchmarks', default = ','.join(name for name, func in BENCHMARKS),
+		help = "comma-separated list of benchmarks to run (default: all)")
+	op.add_option('-n', '--replies', dest = 'replies', default = '1000',
+		help = "comma-separated list of thread sizes, in replies (default: 1000)")
+	op.add_option('-g', '--growth', dest = 'growth', type = 'int', default = 50,
+		help = "number of new replies per poll (default: 50)")
+	op.add_option('-p', '--polls', dest = 'polls', type = 'int', default = 5,
+		help = "number of polls after the initial download (default: 5)")
+	op.add_option('-r', '--repeat', dest = 'repeat', type = 'int', default = 3,
+		help = "number of runs of each timing, of which the best is kept (default: 3)")
+	op.add_option('-w', '--workers', dest = 'workers', type = 'int', default = 4,
+		help = "number of simultaneous downloads (default: 4)")
+	op.add_option('', '--latency', dest = 'latency', type = 'float', default = 0.01,
+		help = "seconds of latency per request to the local server (default: 0.01)")
+	op.add_option('', '--bandwidth', dest = 'bandwidth', type = 'int', default = None,
+		help = "bytes per second per connection from the local server (default: unlimited)")
+
+	(opts, args) = op.parse_args()
+
+	funcs = dict(BENCHMARKS)
+	results = []
+
+	for site in parse_list(opts.sites):
+		for replies in [int(n) for n in parse_list(opts.replies)]:
+			for name in parse_list(opts.benchmarks):
+				result = measure(funcs[name], site, replies, opts)
+				result.update({ 'benchmark' : name, 'site' : site, 'replies' : replies })
+				results.append(result)
+
+				if 'error' in result:
+					sys.stderr.write("{0:>16s} {1:>10s} {2:6d} replies  ERROR {3:s}\n".format(name, site, replies, result['error']))
+				else:
+					sys.stderr.write("{0:>16s} {1:>10s} {2:6d} replies {3:8.3f}s {4:8d} KB peak\n".format(name, site, replies, result['seconds'], result['peak_rss']))
+
+	report = {
+		'python' : platform.python_version(),
+		'platform' : platform.platform(),
+		'time' : time.time(),
+		'options' : opts.__dict__,
+		'results' : results,
+	}
+
+	if opts.output != None:
+		with open(opts.output, 'wb') as f:
+			json.dump(report, f, indent = 2, sort_keys = True)
+	else:
+		json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+		sys.stdout.write('\n')
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+
+from collections import OrderedDict
+
+from chandl import fourchan
+
+TESTDATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testdata')
+
+FOURCHAN_TEMPLATE = os.path.join(TESTDATA, '4chan-simple', '39894014.html.original')
+FOURCHAN_THREAD_END = '</div><hr><div class="navLinks navLinksBot'
+
+WORDS = u'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore'.split()
+
+def fourchan_reply(no, op, rnd):
+	post = {
+		'no' : no,
+		'resto' : op,
+		'now' : u'01/27/14(Mon)12:07',
+		'time' : 1390842451 + (no - op) * 10,
+		'name' : u'Anonymous',
+		'com' : u'<a href="#p{0:d}" class="quotelink">&gt;&gt;{0:d}</a><br>{1:s}'.format(rnd.randint(op, no - 1), u' '.join(rnd.choice(WORDS) for i in range(rnd.randint(5, 60)))),
+	}
+
+	# Roughly a third of all replies have a file
+	if rnd.random() < 0.33:
+		post.update({
+			'tim' : 1390842451000 + no,
+			'ext' : rnd.choice(['.jpg', '.png', '.gif', '.webm']),
+			'filename' : u'file{0:d}'.format(no),
+			'fsize' : rnd.randint(1000, 4000000),
+			'w' : 1280,
+			'h' : 720,
+			'tn_w' : 125,
+			'tn_h' : 70,
+			'md5' : u'cEeDnXfLWSsu3+A/HIZkuw==',
+		})
+
+	return post
+
+def fourchan_replies(count, op=39894014, seed=0):
+	rnd = random.Random(seed)
+	return [fourchan_reply(op + i + 1, op, rnd) for i in range(count)]
+
+def fourchan_thread(replies, seed=0):
+	# Use the simple 4chan test thread as the page, and append synthetic replies to it
+	with open(FOURCHAN_TEMPLATE, 'rb') as f:
+		html = f.read().decode('utf-8')
+
+	i = html.index(FOURCHAN_THREAD_END)
+	posts = fourchan.render_posts('g', fourchan_replies(replies, seed=seed))
+
+	return (html[:i] + posts + html[i:]).encode('utf-8')
+
+TINYBOARD_OP = 1000
+
+TINYBOARD_PAGE = (
+	u'<!doctype html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>/b/ - Random</title>\n'
+	u'<link rel="stylesheet" media="screen" href="/stylesheets/style.css">\n'
+	u'<script type="text/javascript" src="/main.js"></script>\n'
+	u'</head>\n<body>\n<header><h1>/b/ - Random</h1></header>\n'
+	u'<form name="postcontrols" action="/post.php" method="post">\n'
+	u'<div id="thread_{op:d}">{posts:s}<br class="clear"/><hr/></div>\n'
+	u'</form>\n'
+	u'<footer><p class="unimportant">Powered by <a href="http://tinyboard.org/">Tinyboard</a></p></footer>\n'
+	u'</body>\n</html>\n'
+)
+
+TINYBOARD_POST = (
+	u'<div class="post {kind:s}" id="{kind:s}_{no:d}">'
+	u'<p class="intro"><a id="{no:d}" class="post_anchor"></a><input type="checkbox" class="delete" name="delete_{no:d}" id="delete_{no:d}" />'
+	u'<label for="delete_{no:d}"><span class="name">{name:s}</span> <time>{now:s}</time></label>&nbsp;'
+	u'<a class="post_no" href="/b/res/{op:d}.html#{no:d}">No.</a><a class="post_no" href="/b/res/{op:d}.html#q{no:d}">{no:d}</a></p>'
+	u'{file:s}<div class="body">{com:s}</div></div>'
+)
+
+TINYBOARD_FILE = (
+	u'<p class="fileinfo">File: <a href="/b/src/{tim:d}{ext:s}">{tim:d}{ext:s}</a> <span class="unimportant">({size:s}, {w:d}x{h:d})</span></p>'
+	u'<a href="/b/src/{tim:d}{ext:s}" target="_blank"><img class="post-image" src="/b/thumb/{tim:d}.png" style="width:{tn_w:d}px;height:{tn_h:d}px" alt="" /></a>'
+)
+
+def tinyboard_post(post, op):
+	if 'tim' in post:
+		file = TINYBOARD_FILE.format(size = fourchan.format_size(post['fsize']), **post)
+	else:
+		file = u''
+
+	return TINYBOARD_POST.format(kind = 'op' if post['no'] == op else 'reply', op = op, file = file, **post)
+
+def tinyboard_thread(replies, seed=0):
+	op = fourchan_reply(TINYBOARD_OP, TINYBOARD_OP - 1, random.Random(seed))
+	posts = [op] + fourchan_replies(replies, op=TINYBOARD_OP, seed=seed)
+
+	# Posts are separated by line breaks on Tinyboard
+	html = u'<br/>'.join(tinyboard_post(p, TINYBOARD_OP) for p in posts)
+
+	return TINYBOARD_PAGE.format(op = TINYBOARD_OP, posts = html).encode('utf-8')
+
+MLPCHAN_OP = 2000
+
+MLPCHAN_PAGE = (
+	u'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>/pony/ - Pony</title>\n'
+	u'<link rel="stylesheet" href="/stylesheets/style.css">\n'
+	u'<link rel="stylesheet" id="stylesheet" href="/stylesheets/mlpchan.css">\n'
+	u'<script type="text/javascript" src="/js/main.js"></script>\n'
+	u'</head>\n<body>\n'
+	u'<div class="mature_warning">This thread has been marked as mature.</div>\n'
+	u'<form name="postcontrols" action="/post.php" method="post">\n'
+	u'<div class="thread mature_thread" id="t{op:d}" style="display:none">{posts:s}</div>\n'
+	u'</form>\n</body>\n</html>\n'
+)
+
+MLPCHAN_FILE = (
+	u'<div class="file" id="f{no:d}">'
+	u'<div class="fileText" id="fT{no:d}">File: <a href="/pony/src/{tim:d}{ext:s}" target="_blank">{tim:d}{ext:s}</a> ({size:s}, {w:d}x{h:d})</div>'
+	u'<a class="fileThumb" href="/pony/src/{tim:d}{ext:s}" target="_blank">'
+	u'<img class="postimg" src="/pony/spoiler.png" data-mature-src="/pony/thumb/{tim:d}s.jpg" alt="{size:s}" style="height: {tn_h:d}px; width: {tn_w:d}px;"></a>'
+	u'</div>'
+)
+
+def mlpchan_post(post):
+	if 'tim' in post:
+		file = MLPCHAN_FILE.format(size = fourchan.format_size(post['fsize']), **post)
+	else:
+		file = u''
+
+	return fourchan.POST_TEMPLATE.format(trip = u'', sub = u'', file = file, **post)
+
+def mlpchan_thread(replies, seed=0):
+	op = fourchan_reply(MLPCHAN_OP, MLPCHAN_OP - 1, random.Random(seed))
+	posts = [op] + fourchan_replies(replies, op=MLPCHAN_OP, seed=seed)
+
+	return MLPCHAN_PAGE.format(op = MLPCHAN_OP, posts = u''.join(mlpchan_post(p) for p in posts)).encode('utf-8')
+
+# Thread URL and page generator of each board type
+# Pages generated with the same seed and more replies contain the same posts, followed by the new ones
+THREADS = OrderedDict([
+	('4chan', ('http://boards.4chan.org/g/thread/39894014', fourchan_thread)),
+	('tinyboard', ('http://tinyboard.example/b/res/{0:d}.html'.format(TINYBOARD_OP), tinyboard_thread)),
+	('mlpchan', ('http://mlpchan.net/pony/res/{0:d}.html'.format(MLPCHAN_OP), mlpchan_thread)),
+])
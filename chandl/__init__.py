@@ -3,5 +3,19 @@
 __title__ = 'chandl'
 
 from .downloader import ThreadDownloader
+from .parser import ThreadParser
+from .session import PooledSession
+from .ratelimit import RateLimiter
+from .metrics import Metrics, NullMetrics
+from .store import MediaStore
+from .assets import AssetCache
+from .manifest import DownloadManifest
+from .journal import DownloadJournal
+from .validators import ValidatorCache
+from .scheduler import ThreadWatch, Scheduler, IncrementalInterval, AdaptiveInterval
+from .catalog import BoardCatalog, CatalogWatch
+from .workers import ParserPool
+from .engine import DownloadEngine
+from .daemon import ControlServer
 from .exceptions import *
 from requests import ConnectionError
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+from .utils import atomic_write
+from .store import MediaStore, link_file
+from .exceptions import *
+
+class AssetCache(object):
+	# Files of the site itself (stylesheets, scripts, icons and images), downloaded once and linked into every thread's folder
+	# Each one is revalidated with the server at most once every max_age seconds
+
+	def __init__(self, root, max_age=3600, link_mode='hard'):
+		if link_mode not in MediaStore.LINK_MODES:
+			raise ValueError("Unknown link mode '{0:s}'.".format(link_mode))
+
+		self.root = os.path.abspath(root)
+		self.max_age = max_age
+		self.link_mode = link_mode
+
+		# State of each cached asset as {etag, last-modified, checked} by URL, kept in a single file as there are only a few
+		self.filename = os.path.join(self.root, 'assets.json')
+		self.entries = {}
+
+		if os.path.isfile(self.filename):
+			try:
+				with open(self.filename, 'rb') as f:
+					self.entries = json.load(f)
+			except ValueError:
+				logger.warn("Ignoring invalid asset cache state [{0:s}].".format(self.filename))
+
+		self._lock = threading.Lock()
+
+		# Saves of the state take turns, so the file always ends up with the latest entries
+		self._save_lock = threading.Lock()
+
+		# Locks by URL, so each asset is only downloaded once when several threads need it at the same time
+		self._url_locks = {}
+
+	def path_for(self, relpath):
+		# Assets are kept at the same path relative to the cache as relative to thread folders
+		return os.path.join(self.root, *relpath.split('/'))
+
+	def _url_lock(self, url):
+		with self._lock:
+			return self._url_locks.setdefault(url, threading.Lock())
+
+	def _save(self):
+		with self._save_lock:
+			with self._lock:
+				data = json.dumps(self.entries, indent = 1, sort_keys = True)
+
+			atomic_write(self.filename, [data])
+
+	def get(self, url, relpath, fetch):
+		# Return the cached copy of an asset, downloading or revalidating it first if it has not been checked for max_age seconds
+		# fetch(url, filename, headers) downloads it and returns the response headers, raising ThreadHTTPError on errors and 304s
+		filename = self.path_for(relpath)
+
+		with self._url_lock(url):
+			entry = self.entries.get(url)
+			now = time.time()
+
+			if entry != None and os.path.isfile(filename):
+				if now - entry['checked'] < self.max_age:
+					return filename
+
+				headers = {}
+				if entry['etag'] != None:
+					headers['If-None-Match'] = entry['etag']
+
+				if entry['last-modified'] != None:
+					headers['If-Modified-Since'] = entry['last-modified']
+			else:
+				headers = {}
+
+			try:
+				headers = fetch(url, filename, headers)
+				entry = {'etag' : headers.get('etag'), 'last-modified' : headers.get('last-modified'), 'checked' : now}
+			except ThreadHTTPError as e:
+				if e.code != 304:
+					raise
+
+				logger.debug("Asset [{0:s}] not modified.".format(url))
+				entry = dict(entry, checked = now)
+
+			with self._lock:
+				self.entries[url] = entry
+
+			self._save()
+
+		return filename
+
+	def link(self, filename, saveto):
+		link_file(filename, saveto, self.link_mode)
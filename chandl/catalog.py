@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+import time
+
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+from requests import ConnectionError
+
+from .exceptions import *
+from .session import PooledSession
+from . import fourchan
+
+class BoardCatalog(object):
+	# URL pattern
+	BOARD_URL_PATTERN = r'(?:https?://)?([\w\.]+)/(\w+)'
+
+	def __init__(self, board_url, session=None):
+		self.board_url = board_url
+
+		if session != None:
+			self.session = session
+		else:
+			self.session = PooledSession()
+
+		m = re.match(self.BOARD_URL_PATTERN, self.board_url)
+		if m == None:
+			raise UnsupportedSite
+
+		self.site, self.board = m.groups()
+		self.scheme = urlparse(self.board_url).scheme or 'http'
+
+		if self.site == 'boards.4chan.org':
+			self.catalog_url = fourchan.catalog_url(self.board_url, self.board)
+		else:
+			# Tinyboard and its derivatives serve the same catalog format from the board itself
+			self.catalog_url = '{0:s}://{1:s}/{2:s}/catalog.json'.format(self.scheme, self.site, self.board)
+
+		self.last_modified = None
+
+		# Bandwidth and request rate limiter shared with the thread downloaders (None = unlimited)
+		self.rate_limiter = None
+
+		# Threads found by the last poll, keyed by thread number
+		self.threads = {}
+
+	def thread_url(self, thread_id):
+		if self.site == 'boards.4chan.org':
+			return fourchan.thread_url(self.board_url, self.board, thread_id)
+
+		return '{0:s}://{1:s}/{2:s}/res/{3:d}.html'.format(self.scheme, self.site, self.board, thread_id)
+
+	def fetch(self):
+		# Download the catalog, and return its threads keyed by thread number - or None if it has not been modified
+		headers = {}
+
+		if self.last_modified != None:
+			headers['If-Modified-Since'] = self.last_modified
+
+		if self.rate_limiter != None:
+			self.rate_limiter.request(self.catalog_url)
+
+		r = self.session.get(self.catalog_url, headers=headers)
+		try:
+			if r.status_code == 304:
+				return None
+			elif r.status_code == 404:
+				raise ThreadNotFound("Board not found [{0:s}]".format(self.board_url))
+			elif not r:
+				raise ThreadHTTPError(self.catalog_url, r.status_code, r.reason)
+
+			if self.rate_limiter != None:
+				self.rate_limiter.transfer(self.catalog_url, len(r.content))
+
+			pages = r.json()
+			self.last_modified = r.headers.get('last-modified')
+		finally:
+			r.close()
+
+		threads = {}
+		for page in pages:
+			for thread in page.get('threads', []):
+				threads[thread['no']] = thread
+
+		return threads
+
+	def poll(self):
+		# Poll the catalog, and return the numbers of threads that were added, changed and removed since the last poll
+		threads = self.fetch()
+
+		if threads == None:
+			return [], [], []
+
+		def version(thread):
+			return thread.get('last_modified'), thread.get('replies'), thread.get('images')
+
+		added = [no for no in threads if no not in self.threads]
+		changed = [no for no in threads if no in self.threads and version(threads[no]) != version(self.threads[no])]
+		removed = [no for no in self.threads if no not in threads]
+
+		self.threads = threads
+
+		return sorted(added), sorted(changed), sorted(removed)
+
+class CatalogWatch(object):
+	def __init__(self, catalog, scheduler, watch_factory, interval=60, subject=None, min_replies=0, retry=10, retry_increment=120, output_callback=None, report_callback=None, retire_callback=None):
+		self.catalog = catalog
+		self.scheduler = scheduler
+
+		# Called with a thread URL to create a watch for it, or return None to skip the thread
+		self.watch_factory = watch_factory
+
+		self.interval = interval
+
+		# Only threads whose subject matches this pattern and which have at least this many replies are watched
+		if subject != None:
+			self.subject = re.compile(subject)
+		else:
+			self.subject = None
+
+		self.min_replies = min_replies
+
+		self.max_retries = retry
+		self.retry_increment = retry_increment
+
+		if output_callback != None:
+			self._output = output_callback
+
+		if report_callback != None:
+			self._report = report_callback
+
+		if retire_callback != None:
+			self._retired = retire_callback
+
+		self.retries = 0
+		self.last_check = None
+
+		# Watches of the threads currently being followed, keyed by thread number
+		self.watches = {}
+
+		# Threads that have been skipped or are no longer followed - these are never picked up again
+		self.retired = set()
+
+	def _output(self, text):
+		pass
+
+	def _report(self, text):
+		pass
+
+	def _retired(self, watch):
+		pass
+
+	@property
+	def url(self):
+		return self.catalog.board_url
+
+	def matches(self, thread):
+		if thread.get('replies', 0) < self.min_replies:
+			return False
+
+		if self.subject != None and self.subject.search(thread.get('sub', u'')) == None:
+			return False
+
+		return True
+
+	def _retire(self, no, reason):
+		watch = self.watches.pop(no)
+		self.retired.add(no)
+
+		self._output("Thread [{0:s}] {1:s}. No longer watching it.".format(watch.url, reason))
+
+		# A watch being checked is only retired once its check is done
+		if watch in self.scheduler:
+			self.scheduler.remove(watch, self._retired)
+		else:
+			self._retired(watch)
+
+	def check(self):
+		# Check the catalog for new and changed threads once, and return whether it should be checked again
+		self._report("Checking catalog [{0:s}] for new threads...".format(self.url))
+
+		try:
+			added, changed, removed = self.catalog.poll()
+		except ThreadNotFound as e:
+			self._output(e)
+			return False
+		except (ThreadHTTPError, ConnectionError, ValueError) as e:
+			self._output(e)
+
+			if self.retries < self.max_retries:
+				self.retries += 1
+				return True
+
+			return False
+		finally:
+			self.last_check = time.time()
+
+		self.retries = 0
+
+		# Forget threads whose watch has stopped by itself (ie. 404 or too many failed checks)
+		for no, watch in self.watches.items():
+			if watch not in self.scheduler:
+				self._retire(no, "has stopped")
+
+		for no in removed:
+			if no in self.watches:
+				self._retire(no, "fell off the catalog")
+
+		now = time.time()
+
+		# Threads that have changed since the last poll are checked right away, instead of waiting for their own interval
+		for no in changed:
+			if no in self.watches:
+				watch = self.watches[no]
+
+				if watch.next_check() > now:
+					self.scheduler.remove(watch)
+					self.scheduler.add(watch, due = now)
+
+		# Pick up any new threads matching the filters - including known threads that did not match before
+		for no, thread in sorted(self.catalog.threads.items()):
+			if no in self.watches or no in self.retired or not self.matches(thread):
+				continue
+
+			url = self.catalog.thread_url(no)
+			watch = self.watch_factory(url)
+
+			if watch == None:
+				self.retired.add(no)
+				continue
+
+			self._output("Found new thread [{0:s}].".format(url))
+
+			self.watches[no] = watch
+			self.scheduler.add(watch)
+
+		return True
+
+	def next_interval(self):
+		if self.retries == 0:
+			return self.interval
+
+		return self.retry_increment * self.retries
+
+	def next_check(self):
+		if self.last_check == None:
+			return time.time()
+
+		return self.last_check + self.next_interval()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+from .catalog import CatalogWatch
+from .exceptions import *
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		logger.debug("Control request: " + format % args)
+
+	def _respond(self, code, body=None):
+		data = json.dumps(body) if body != None else ''
+
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def _allowed(self):
+		# Only accept requests addressed to this server on localhost, so web pages cannot reach it through DNS rebinding
+		port = self.server.server_address[1]
+		if self.headers.get('Host') not in ('127.0.0.1:{0:d}'.format(port), 'localhost:{0:d}'.format(port)):
+			self._respond(403, {'error' : "Forbidden."})
+			return False
+
+		return True
+
+	def _path(self):
+		up = urlparse(self.path)
+		return up.path.rstrip('/'), parse_qs(up.query)
+
+	def do_GET(self):
+		if not self._allowed():
+			return
+
+		path, query = self._path()
+
+		if path != '/threads':
+			self._respond(404, {'error' : "Not found."})
+			return
+
+		self._respond(200, self.server.control.status())
+
+	def do_POST(self):
+		if not self._allowed():
+			return
+
+		path, query = self._path()
+
+		if path != '/threads':
+			self._respond(404, {'error' : "Not found."})
+			return
+
+		# Browsers can send other content types to any site without asking it first, but not JSON
+		if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+			self._respond(415, {'error' : "Expected application/json."})
+			return
+
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			url = body['url']
+		except (ValueError, TypeError, KeyError):
+			self._respond(400, {'error' : "Expected a JSON object with the URL to watch."})
+			return
+
+		try:
+			watch, added = self.server.control.add(url)
+		except UnsupportedSite:
+			self._respond(400, {'error' : "Unsupported site [{0:s}].".format(url)})
+			return
+
+		if watch == None:
+			self._respond(409, {'error' : "Thread [{0:s}] could not be watched.".format(url)})
+			return
+
+		self._respond(201 if added else 200, self.server.control.watch_status(watch))
+
+	def do_DELETE(self):
+		if not self._allowed():
+			return
+
+		path, query = self._path()
+
+		if path != '/threads' or 'url' not in query:
+			self._respond(404, {'error' : "Not found."})
+			return
+
+		url = query['url'][0]
+
+		if not self.server.control.remove(url):
+			self._respond(404, {'error' : "Not watching [{0:s}].".format(url)})
+			return
+
+		self._respond(204)
+
+class ControlServer(object):
+	# Lets a running process be told what to watch, and asked how it is going, over HTTP on localhost
+	#   GET /threads                 - state of every watch
+	#   POST /threads {"url": URL}   - start watching a thread (or board, depending on the watch factory)
+	#   DELETE /threads?url=URL      - stop watching a thread
+
+	def __init__(self, scheduler, watch_factory, retire_callback=None, host='127.0.0.1', port=0):
+		self.scheduler = scheduler
+
+		# Returns a new watch for a URL, or None if it cannot be watched
+		self.watch_factory = watch_factory
+
+		if retire_callback != None:
+			self._retired = retire_callback
+
+		self.host = host
+		self.port = port
+
+		# Last (time, bytes downloaded, bytes per second) of each thread, for estimating its current transfer rate
+		self._samples = {}
+
+		# Adding the same URL from two requests at once must not create two watches
+		self._lock = threading.Lock()
+
+		self._server = None
+		self._thread = None
+
+	def _retired(self, watch):
+		pass
+
+	@property
+	def url(self):
+		host, port = self._server.server_address
+		return 'http://{0:s}:{1:d}'.format(host, port)
+
+	def find(self, url):
+		for watch in self.scheduler.watches:
+			if watch.url == url:
+				return watch
+
+		return None
+
+	def add(self, url):
+		# Return the watch for the URL and whether it was added, or (None, False) if it cannot be watched
+		with self._lock:
+			watch = self.find(url)
+			if watch != None:
+				return watch, False
+
+			watch = self.watch_factory(url)
+			if watch == None:
+				return None, False
+
+			self.scheduler.add(watch)
+
+		logger.info("Watching [{0:s}] on request.".format(url))
+		return watch, True
+
+	def remove(self, url):
+		with self._lock:
+			watch = self.find(url)
+			if watch == None:
+				return False
+
+			self._samples.pop(watch, None)
+
+		# A watch being checked is only retired (and its PID file released) once its check is done
+		self.scheduler.remove(watch, self._retired)
+
+		logger.info("No longer watching [{0:s}] on request.".format(url))
+		return True
+
+	def _rate(self, watch, now):
+		# Bytes per second received since the last sample, taken at most once a second
+		downloaded = watch.downloader.bytes_downloaded
+		sample = self._samples.get(watch)
+
+		if sample == None:
+			self._samples[watch] = (now, downloaded, 0.0)
+			return 0.0
+
+		then, previous, rate = sample
+		if now - then >= 1:
+			rate = (downloaded - previous) / (now - then)
+			self._samples[watch] = (now, downloaded, rate)
+
+		return rate
+
+	def watch_status(self, watch, now=None):
+		if now == None:
+			now = time.time()
+
+		status = {
+			'url' : watch.url,
+			'next_check' : self.scheduler.due(watch),
+			'last_check' : watch.last_check,
+			'retries' : watch.retries,
+		}
+
+		if isinstance(watch, CatalogWatch):
+			status['type'] = 'catalog'
+			status['threads'] = len(watch.watches)
+		else:
+			downloader = watch.downloader
+
+			status['type'] = 'thread'
+			status['last_update'] = watch.last_update
+			status['new_posts'] = downloader.new_posts
+			status['queued'] = len(downloader.download_queue)
+			status['bytes_downloaded'] = downloader.bytes_downloaded
+			status['bytes_per_second'] = self._rate(watch, now)
+
+		# Being checked right now, so it has no due time
+		status['checking'] = status['next_check'] == None and watch in self.scheduler
+
+		return status
+
+	def status(self):
+		now = time.time()
+
+		with self._lock:
+			return [self.watch_status(watch, now) for watch in self.scheduler.watches]
+
+	def start(self):
+		self._server = ThreadingHTTPServer((self.host, self.port), ControlRequestHandler)
+		self._server.control = self
+
+		self._thread = threading.Thread(target = self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+		self._thread.join()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import os
 import logging
 import re
 import time
 import calendar
 import posixpath
+import json
+import shutil
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +18,18 @@ from urllib import unquote
 from urlparse import urlparse, urljoin
 from email.utils import formatdate, parsedate
 
-from .utils import movefile
+from .utils import movefile, makedirs
 from .exceptions import *
 from .parser import ThreadParser
+from .pool import DownloadPool
+from .manifest import DownloadManifest
+from .journal import DownloadJournal
+from .validators import ValidatorCache
+from .priority import default_priority, is_static_asset
+from .metrics import NullMetrics
+from .session import PooledSession
+from .helpers import post_number
+from . import fourchan
 
 import requests
 
@@ -35,9 +48,15 @@ class ThreadDownloader(object):
 		r'(?:https?://)?([^/]+)(?:/.+?)?/(\w+)/res/(\d+)',
 	]
 
-	def __init__(self, thread_url, save_dir, save_filename, output_callback=None, progress_callback=None, cancel_callback=None):
+	def __init__(self, thread_url, save_dir, save_filename, output_callback=None, progress_callback=None, cancel_callback=None, session=None):
 		self.thread_url = thread_url
 
+		# Use the supplied session if any, so connections can be shared with other downloaders
+		if session != None:
+			self.session = session
+		else:
+			self.session = PooledSession()
+
 		self.download_extensions = set(['.ico', '.css', '.png', '.jpg', '.gif', '.webm'])
 
 		if output_callback != None:
@@ -71,9 +90,75 @@ class ThreadDownloader(object):
 		self.set_destination(save_dir, save_filename)
 
 		self._parser = None
+		self._restored = False
 		self.download_queue = deque()
+
+		# Approximate sizes of queued files, where known
+		self.download_sizes = {}
+
+		# Returns the sort key of a queued download, given its URL and size (None if unknown)
+		self.priority = default_priority
 		self.last_modified = None
 
+		# Number of new posts found by the last successful download (None if unknown)
+		self.new_posts = None
+
+		# Use the 4chan JSON API to check for new posts, where available
+		self.use_api = False
+		self.api_last_modified = None
+
+		if self.site == 'boards.4chan.org':
+			self.api_url = fourchan.api_url(self.thread_url, self.board, self.thread_id)
+		else:
+			self.api_url = None
+
+		# Record completed files in a manifest, instead of checking for them on disk
+		self.use_manifest = True
+		self.manifest = None
+
+		# Journal the download queue to disk, so pending downloads survive the process dying
+		self.use_journal = True
+		self.journal = None
+
+		# Keep the ETag and Last-Modified of every URL downloaded, for making conditional requests
+		self.use_validators = True
+		self.validators = None
+
+		# Downloaded files queued to be revalidated, rather than downloaded
+		self._revalidating = set()
+
+		# Release the parsed thread after each check, and parse it again from the saved file only when it is needed
+		self.low_memory = False
+
+		# Worker process pool to parse and save the thread in, usually shared by all downloaders (None = parse in this process)
+		self.parser_pool = None
+
+		# Board type identified by the last job in the pool, so later jobs do not have to identify it again
+		self._board_type = None
+
+		# Engine to run checks and file transfers on, usually shared by all downloaders (None = run them in the calling thread)
+		self.engine = None
+
+		# Total bytes of files received, counted as they arrive
+		self.bytes_downloaded = 0
+		self._bytes_lock = threading.Lock()
+
+		# Content-addressed store shared between threads (None = disabled)
+		self.store = None
+
+		# Cache of the site's own files shared between threads, which are linked from it instead of downloaded (None = disabled)
+		self.asset_cache = None
+
+		# Number of files to download simultaneously, and the maximum number of simultaneous downloads per host (None = no limit)
+		self.workers = 1
+		self.host_workers = None
+
+		# Bandwidth and request rate limiter, usually shared by all downloaders (None = unlimited)
+		self.rate_limiter = None
+
+		# Records time spent in each phase of a check, along with download counters
+		self.metrics = NullMetrics()
+
 	def set_destination(self, save_dir, save_filename=None, no_subdir=False):
 		# If save_dir is None, set it to none and do no further processing - it will have to be set by the user later by calling set_destination() again
 		if save_dir == None:
@@ -102,44 +187,134 @@ class ThreadDownloader(object):
 		return False
 
 	def download(self, force=False):
+		# With an engine, the check runs on its threads along with those of other downloaders, and this only waits for it
+		# (unless it is called from one of them already, ie. by a scheduler running its checks on the engine)
+		if self.engine != None and not self.engine.in_check():
+			self.engine.check(self._download, force).result()
+		else:
+			self._download(force)
+
+	def _download(self, force):
 		# If destination directory has not yet been set, throw exception
 		if self.save_dir == None:
 			raise NoSaveDir
 
+		# Queued files that could not be downloaded before fetching the page, which are left for the next check
+		held = []
+
 		try:
 			headers = {}
 
 			# Construct filename of original unmodified HTML
 			originalfile = '{0:s}.original'.format(self.save_path)
 
-			if self._parser == None:
+			if self.use_manifest and self.manifest == None:
+				self._load_manifest()
+
+			if self.use_journal and self.journal == None:
+				self._load_journal()
+
+			if self.use_validators and self.validators == None:
+				self.validators = ValidatorCache('{0:s}.validators'.format(self.save_path))
+
+			# Finish any downloads left over from the last check (or a run that died) before fetching the page again
+			if len(self.download_queue) > 0:
+				self._output("Resuming {0:d} queued downloads for [{1:s}]...".format(len(self.download_queue), self.thread_url))
+
+				try:
+					self._download_queued()
+				except (ThreadHTTPError, requests.ConnectionError, IncompleteDownload) as e:
+					# A file that keeps failing must not keep the thread itself from being updated
+					# It stays queued (and in the journal), but is only tried again on the next check
+					logger.warn("Failed to resume queued downloads for [{0:s}]: {1:s}".format(self.thread_url, str(e)))
+					self._output("{0:d} queued downloads for [{1:s}] failed. Trying them again on the next check.".format(len(self.download_queue), self.thread_url))
+
+					held = list(self.download_queue)
+					self.download_queue.clear()
+
+			# Construct filename of the last thread JSON retrieved from the API
+			apifile = '{0:s}.json'.format(self.save_path)
+
+			if not self._restored:
 				if os.path.isfile(originalfile):
 					self.last_modified = formatdate(os.path.getmtime(originalfile))
 
+				if os.path.isfile(apifile):
+					self.api_last_modified = formatdate(os.path.getmtime(apifile))
+
+				self._restored = True
+
+			if self._parser == None and self.parser_pool == None:
 				if os.path.isfile(self.save_path):
 					self._parser = ThreadParser(self.thread_url, self.save_path, output_callback=self._output)
 				else:
 					self._parser = ThreadParser(self.thread_url, output_callback=self._output)
 
-			if self.last_modified != None and not force:
-				headers['If-Modified-Since'] = self.last_modified
-
-			# Download page HTML
-			tmpfile = '{0:s}.tmp'.format(self.save_path)
+				self._parser.metrics = self.metrics
+
+			# The API can only be used to update a thread that has already been downloaded, as the page layout is not in it
+			if self._parser != None:
+				has_document = self._parser.has_document()
+			else:
+				has_document = os.path.isfile(self.save_path)
+
+			use_api = self.use_api and self.api_url != None and not force and has_document
+
+			if use_api:
+				url = self.api_url
+				savefile = apifile
+				last_modified = self.api_last_modified
+			else:
+				url = self.thread_url
+				savefile = originalfile
+				last_modified = self.last_modified
+
+			# When forced, the page is only revalidated - if it has not changed, the last one downloaded is processed again
+			if not force or os.path.isfile(savefile):
+				if self.validators != None and url in self.validators:
+					headers.update(self.validators.headers(url))
+				elif last_modified != None and not force:
+					headers['If-Modified-Since'] = last_modified
+
+			# Download page HTML (or thread JSON)
+			tmpfile = '{0:s}.tmp'.format(savefile if use_api else self.save_path)
 			try:
-				headers = download_file(self.thread_url, tmpfile, headers = headers)
+				with self.metrics.timer('fetch', thread = self.thread_url):
+					headers = download_file(url, tmpfile, headers = headers, session = self.session, rate_limiter = self.rate_limiter, metrics = self.metrics)
 			except ThreadHTTPError as e:
-				if e.code == 304:
+				if e.code == 304 and force:
+					self.metrics.increment('not_modified', thread = self.thread_url)
+					self._output("Thread [{0:s}] not modified. Processing the last downloaded page again.".format(self.thread_url))
+
+					shutil.copyfile(savefile, tmpfile)
+					headers = {}
+				elif e.code == 304:
+					self.metrics.increment('not_modified', thread = self.thread_url)
 					raise ThreadNotModified("Thread already up to date [{0:s}]".format(self.thread_url))
 				elif e.code == 404:
+					self.metrics.increment('not_found', thread = self.thread_url)
 					raise ThreadNotFound("Thread not found [{0:s}]".format(self.thread_url))
 				else:
 					raise
 
-			# Parse new HTML file
-			self._parser.update(tmpfile)
+			if self.parser_pool != None:
+				links, link_hashes, link_sizes, savedfile = self._update_in_pool(use_api, tmpfile)
+			else:
+				if use_api:
+					# Render and merge only the posts that are newer than the last one we have
+					last_post = post_number(self._parser.last_post_id())
+					newposts = [p for p in fourchan.load_posts(tmpfile) if p['no'] > last_post]
+					self._parser.update_posts(fourchan.render_posts(self.board, newposts))
+				else:
+					# Parse new HTML file
+					self._parser.update(tmpfile)
+
+				self.new_posts = self._parser.new_post_count
+
+				links, link_hashes, link_sizes = self._parser.links_found, self._parser.link_hashes, self._parser.link_sizes
+				self._parser.links_found = []
 
-			for abslink, relpath in self._parser.links_found:
+			for abslink, relpath in links:
 				path, filename = posixpath.split(relpath)
 				saveto = os.path.join(self.save_dir, path, unquote(filename))
 
@@ -151,20 +326,201 @@ class ThreadDownloader(object):
 					logger.debug("File '{0:s}' is not in the list of extensions to download. Skipped.".format(filename))
 					continue
 
-				# If local file does not already exist, download it
-				if os.path.isfile(saveto):
+				# If local file has not already been downloaded, download it
+				if self._is_downloaded(saveto):
 					logging.debug("File at {0:s} already exists locally. Skipped.".format(abslink))
 					continue
 
+				# If the file's hash is known and its content is already in the store, link to it instead of downloading it
+				digest = link_hashes.get(relpath)
+				if self.store != None and digest != None and self.store.has(digest):
+					self.store.link(digest, saveto)
+					self._record_downloaded(saveto, digest)
+					self._output("[{0:s}] linked from store.".format(abslink))
+					continue
+
 				# Call new file event
 				self._output("Link found [{0:s}]".format(abslink))
 
 				self.download_queue.append((abslink, saveto))
 
-			self._parser.links_found = []
+				size = link_sizes.get(relpath)
+				if size != None:
+					self.download_sizes[saveto] = size
+
+			# When forced, check every downloaded file that can be revalidated cheaply for changes
+			if force and self.validators != None:
+				for abslink, path in self.validators.files():
+					saveto = os.path.join(self.save_dir, *path.split('/'))
+
+					if saveto not in self._revalidating and self._is_downloaded(saveto):
+						self._revalidating.add(saveto)
+						self.download_queue.append((abslink, saveto))
+
+			# Record the queue before saving the thread, so its files are still downloaded if the process dies before they are
+			if self.journal != None:
+				self.journal.add((url, self._manifest_path(saveto)) for url, saveto in self.download_queue)
+
+			# Save modified HTML to file
+			logger.info("Writing modified HTML to file: {0:s}...".format(self.save_path))
+
+			if self.parser_pool != None:
+				# The pool has already written the new file, so it only has to be moved into place
+				if savedfile != None:
+					movefile(savedfile, self.save_path)
+			else:
+				self._parser.save(self.save_path)
+
+				if self.low_memory:
+					self._parser.release(self.save_path)
+
+			# If the page was not modified, its validators are unchanged
+			if len(headers) > 0:
+				last_modified = headers['last-modified'] if 'last-modified' in headers else None
+
+				if use_api:
+					self.api_last_modified = last_modified
+				else:
+					self.last_modified = last_modified
+
+				if self.validators != None:
+					self.validators.update(url, headers)
+
+			# Rename temporary HTML (or JSON) file to original file
+			movefile(tmpfile, savefile)
+
+			self._download_queued()
+
+			self._output("Thread [{0:s}] downloaded to [{1:s}]".format(self.thread_url, self.save_path))
+		finally:
+			self.download_queue.extend(held)
+
+	def _update_in_pool(self, use_api, tmpfile):
+		# Merge the downloaded page (or thread JSON) into the saved thread in the parser pool
+		# Returns the links found with their known hashes and sizes, and the new file to move into place (None if unchanged)
+		result = self.parser_pool.update({
+			'url' : self.thread_url,
+			'save_path' : self.save_path,
+			'board_type' : self._board_type,
+			'board' : self.board,
+			'api' : use_api,
+			'input' : tmpfile,
+		})
+
+		self._board_type = result['board_type']
+		self.new_posts = result['new_posts']
+
+		if self.new_posts != None:
+			self._output("{0:d} new posts merged.".format(self.new_posts))
+
+		for phase, seconds in result['phases'].items():
+			self.metrics.record(phase, seconds, thread = self.thread_url)
+
+		return result['links'], result['hashes'], result['sizes'], result['saved']
+
+	def _manifest_path(self, saveto):
+		return posixpath.join(*os.path.relpath(saveto, self.save_dir).split(os.sep))
+
+	def _load_manifest(self):
+		self.manifest = DownloadManifest('{0:s}.manifest'.format(self.save_path))
+
+		# If there is no manifest yet, record the files that have already been downloaded
+		if not self.manifest.exists() and os.path.isdir(os.path.join(self.save_dir, 'files')):
+			self.rebuild_manifest()
+
+	def rebuild_manifest(self):
+		if self.manifest == None:
+			self.manifest = DownloadManifest('{0:s}.manifest'.format(self.save_path))
+
+		self._output("Rebuilding manifest for [{0:s}]...".format(self.thread_url))
+		self.manifest.rebuild(self.save_dir)
+
+	def _load_journal(self):
+		self.journal = DownloadJournal('{0:s}.queue'.format(self.save_path))
+
+		# Pick up downloads that were still pending when the last run ended
+		for url, path in self.journal.pending():
+			item = (url, os.path.join(self.save_dir, *path.split('/')))
+
+			if item not in self.download_queue:
+				self.download_queue.append(item)
 
-			currentfile = 0
-			filestotal = len(self.download_queue)
+	def _is_downloaded(self, saveto):
+		if self.manifest == None:
+			return os.path.isfile(saveto)
+
+		return self._manifest_path(saveto) in self.manifest
+
+	def _record_downloaded(self, saveto, digest=None):
+		if self.manifest != None:
+			self.manifest.add_file(self._manifest_path(saveto), saveto, digest)
+
+	def _prioritize_queued(self):
+		# Sorting is stable, so files of equal priority are still downloaded in the order they were found
+		items = sorted(self.download_queue, key = lambda item: self.priority(item[0], self.download_sizes.get(item[1])))
+
+		self.download_queue.clear()
+		self.download_queue.extend(items)
+
+	def _download_queued(self):
+		self._prioritize_queued()
+
+		with self.metrics.timer('download', thread = self.thread_url):
+			if self.engine != None:
+				self._download_queued_on_engine()
+			elif self.workers > 1:
+				pool = DownloadPool(self.workers, self.host_workers)
+				pool.run(self.download_queue, self._fetch, cancel_callback=self._iscancelling, progress_callback=self._progress)
+			else:
+				self._download_queued_serially()
+
+		self.download_sizes.clear()
+
+		# Everything in the journal is done
+		if self.journal != None:
+			self.journal.compact()
+
+	def _download_queued_serially(self):
+		currentfile = 0
+		filestotal = len(self.download_queue)
+
+		def progress(url, read, size):
+			if size > 0:
+				prg = (float(read) / size) * 100
+			else:
+				prg = -1
+
+			self._progress(prg, currentfile, filestotal, url)
+
+		while len(self.download_queue) > 0:
+			if self._iscancelling():
+				raise CancelException
+
+			url, saveto = self.download_queue.popleft()
+			currentfile += 1
+
+			try:
+				self._fetch(url, saveto, progress)
+			except:
+				self.download_queue.appendleft((url, saveto))
+				raise
+
+	def _download_queued_on_engine(self):
+		# Hand every queued file to the engine at once - it decides how many are transferred at the same time
+		items = list(self.download_queue)
+		self.download_queue.clear()
+
+		filestotal = len(items)
+		state = {
+			'cancelled': False,
+			'completed': 0,
+		}
+		lock = threading.Lock()
+
+		def fetch(url, saveto):
+			# Files that have not been started when the download is cancelled are left in the queue
+			if state['cancelled']:
+				raise CancelException
 
 			def progress(url, read, size):
 				if size > 0:
@@ -172,106 +528,293 @@ class ThreadDownloader(object):
 				else:
 					prg = -1
 
-				self._progress(prg, currentfile, filestotal, url)
+				self._progress(prg, state['completed'] + 1, filestotal, url)
+
+			try:
+				self._fetch(url, saveto, progress)
+			finally:
+				with lock:
+					state['completed'] += 1
+
+		tasks = [(item, self.engine.transfer(fetch, *item)) for item in items]
+		error = None
 
-			while len(self.download_queue) > 0:
+		for item, task in tasks:
+			while not task.wait(0.5):
 				if self._iscancelling():
-					raise CancelException
+					state['cancelled'] = True
 
-				url, saveto = self.download_queue.popleft()
-				currentfile += 1
+			try:
+				task.result()
+			except CancelException:
+				self.download_queue.append(item)
+			except:
+				# Put the failed file back, so it will be retried on the next run
+				self.download_queue.append(item)
+
+				if error == None:
+					error = sys.exc_info()
+
+		if error != None:
+			exctype, value, tb = error
+			raise exctype, value, tb
+
+		if len(self.download_queue) > 0:
+			raise CancelException
+
+	def _fetch(self, url, saveto, progress_callback):
+		revalidate = saveto in self._revalidating
+		self._revalidating.discard(saveto)
+
+		# Skip files completed by an earlier run, which did not get to mark them as done in the journal
+		if not revalidate and self.journal != None and self._is_downloaded(saveto):
+			self.journal.done(self._manifest_path(saveto))
+			return
 
-				try:
-					try:
-						download_file(url, saveto, progress_callback = progress)
-					except ThreadHTTPError as e:
-						if e.code == 404:
-							# Skip non-existent files
-							self._output("[{0:s}] was not found. Skipped.".format(url))
-							continue
-						else:
-							raise
-				except:
-					self.download_queue.appendleft((url, saveto))
-					raise
+		if revalidate:
+			headers = self.validators.headers(url)
+		else:
+			headers = None
 
-				self._output("[{0:s}] downloaded.".format(url))
+		# Last number of bytes read reported for the file (None until connected)
+		received = {'read': None}
 
-			# Save modified HTML to file
-			logger.info("Writing modified HTML to file: {0:s}...".format(self.save_path))
+		def progress(url, read, size):
+			if size == 0:
+				# Not connected yet
+				received['read'] = None
+			elif received['read'] == None:
+				# The first report after connecting includes the part of the file resumed from, which was received earlier
+				received['read'] = read
+			else:
+				with self._bytes_lock:
+					self.bytes_downloaded += read - received['read']
 
-			self._parser.save(self.save_path)
+				received['read'] = read
 
-			self.last_modified = headers['last-modified'] if 'last-modified' in headers else None
+			progress_callback(url, read, size)
 
-			# Rename temporary HTML file to original file
-			movefile(tmpfile, originalfile)
+		# Files of the site itself are the same in every thread, so they are taken from the asset cache
+		asset = self.asset_cache != None and is_static_asset(url)
 
-			self._output("Thread [{0:s}] downloaded to [{1:s}]".format(self.thread_url, self.save_path))
-		finally:
-			pass
+		try:
+			if asset:
+				self._link_asset(url, saveto, progress)
+			else:
+				headers = download_file(url, saveto, headers = headers, progress_callback = progress, session = self.session, resume = True, rate_limiter = self.rate_limiter, metrics = self.metrics)
+		except ThreadHTTPError as e:
+			if e.code == 304 and revalidate:
+				self._output("[{0:s}] not modified.".format(url))
+				self.metrics.increment('not_modified', url = url)
+
+				if self.journal != None:
+					self.journal.done(self._manifest_path(saveto))
+
+				return
+			elif e.code == 404:
+				# Skip non-existent files
+				self._output("[{0:s}] was not found. Skipped.".format(url))
+				self.metrics.increment('not_found', thread = self.thread_url)
+
+				if self.journal != None:
+					self.journal.done(self._manifest_path(saveto))
+
+				return
+			else:
+				raise
+
+		if asset:
+			self._record_downloaded(saveto, None)
+
+			if self.journal != None:
+				self.journal.done(self._manifest_path(saveto))
+
+			self._output("[{0:s}] linked from asset cache.".format(url))
+			return
+
+		# Put the file in the store, so other threads can link to it
+		if self.store != None:
+			digest = self.store.add(saveto)
+		else:
+			digest = None
+
+		self._record_downloaded(saveto, digest)
+		self.metrics.increment('files', thread = self.thread_url)
+
+		if self.validators != None:
+			self.validators.update(url, headers, self._manifest_path(saveto))
+
+		if self.journal != None:
+			self.journal.done(self._manifest_path(saveto))
 
-def download_file(url, saveto, headers=None, progress_callback=None):
+		self._output("[{0:s}] downloaded.".format(url))
+
+	def _link_asset(self, url, saveto, progress_callback):
+		def fetch(url, filename, headers):
+			return download_file(url, filename, headers = headers, progress_callback = progress_callback, session = self.session, rate_limiter = self.rate_limiter, metrics = self.metrics)
+
+		cached = self.asset_cache.get(url, self._manifest_path(saveto), fetch)
+		self.asset_cache.link(cached, saveto)
+
+RE_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+def _read_part_info(infofile):
+	try:
+		with open(infofile, 'rb') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return None
+
+def _remove_part(partfile, infofile):
+	for fn in (partfile, infofile):
+		if os.path.isfile(fn):
+			os.remove(fn)
+
+def download_file(url, saveto, headers=None, progress_callback=None, session=None, resume=False, rate_limiter=None, metrics=None):
 	savetodir, savetofile = os.path.split(saveto)
 
 	# If local directory does not exist, create it
-	if not os.path.exists(savetodir):
-		os.makedirs(savetodir)
+	makedirs(savetodir)
 
 	def progress(*args):
 		if callable(progress_callback):
 			progress_callback(*args)
 
+	# If no session was specified, fall back to unpooled requests
+	if session == None:
+		session = requests
+
+	# Data is written to a partial file, which is only renamed to the real filename once it is complete
+	# If resuming is enabled, the partial file is kept on failure along with the validator needed to resume it
+	partfile = '{0:s}.part'.format(saveto)
+	infofile = '{0:s}.part.info'.format(saveto)
+
+	headers = dict(headers or {})
+	offset = 0
+
+	if resume and os.path.isfile(partfile):
+		info = _read_part_info(infofile)
+		validator = None
+
+		if info != None and info.get('url') == url:
+			validator = info.get('etag') or info.get('last-modified')
+
+		if validator != None and os.path.getsize(partfile) > 0:
+			offset = os.path.getsize(partfile)
+			headers['Range'] = 'bytes={0:d}-'.format(offset)
+			headers['If-Range'] = validator
+			logger.info("Resuming download of [{0:s}] from byte {1:d}.".format(url, offset))
+		else:
+			_remove_part(partfile, infofile)
+
 	# Display progress before attempting to connect
 	progress(url, 0, 0)
 
 	# Attempt to download the new file
 	try:
-		r = requests.get(url, stream=True, headers=headers)
-		if r:
-			if r.status_code == 304:
-				raise ThreadHTTPError(url, r.status_code, r.reason)
+		if rate_limiter != None:
+			rate_limiter.request(url)
 
-			with open(saveto, 'wb') as f:
-				read = 0
+		r = session.get(url, stream=True, headers=headers)
+		try:
+			if r.status_code == 416 and offset > 0:
+				# The partial file is no longer valid for this resource - start over
+				_remove_part(partfile, infofile)
+				r.close()
+				return download_file(url, saveto, headers=dict((k, v) for k, v in headers.items() if k not in ('Range', 'If-Range')), progress_callback=progress_callback, session=session, resume=resume, rate_limiter=rate_limiter, metrics=metrics)
+
+			if r:
+				if r.status_code == 304:
+					raise ThreadHTTPError(url, r.status_code, r.reason)
 
 				if 'content-length' in r.headers:
 					size = int(r.headers['content-length'])
 				else:
 					size = -1
 
-				# Print initial progress report
-				progress(url, read, size)
+				mode = 'wb'
+				read = 0
 
-				try:
-					# Iterate through the downloaded file content chunk by chunk and write it to file
-					for chunk in r.iter_content(chunk_size=1024):
-						if chunk:
-							f.write(chunk)
-							f.flush()
-
-							read += len(chunk)
-
-							# Report progress
-							progress(url, read, size)
-				except requests.RequestException as e:
-					logger.error("RequestException downloading [{0:s}]: {1:s}", url, str(e))
+				if r.status_code == 206:
+					m = RE_CONTENT_RANGE.match(r.headers.get('content-range', ''))
+
+					if m == None or int(m.group(1)) != offset:
+						# The partial file cannot be resumed from this response, so start over next time
+						_remove_part(partfile, infofile)
+						raise IncompleteDownload("Server returned an unexpected range for [{0:s}]".format(url))
+
+					# Append to the partial file
+					mode = 'ab'
+					read = offset
+
+					if size >= 0:
+						size += offset
+				elif offset > 0:
+					logger.info("Server did not honor range request for [{0:s}]. Downloading the whole file.".format(url))
+
+				if resume:
+					# Save validator, so the download can be resumed if it fails
+					with open(infofile, 'wb') as f:
+						json.dump({
+							'url' : url,
+							'etag' : r.headers.get('etag'),
+							'last-modified' : r.headers.get('last-modified'),
+						}, f)
+
+				with open(partfile, mode) as f:
+					# Print initial progress report
+					progress(url, read, size)
+
+					start = read
+
+					try:
+						# Iterate through the downloaded file content chunk by chunk and write it to file
+						for chunk in r.iter_content(chunk_size=1024):
+							if chunk:
+								f.write(chunk)
+								f.flush()
+
+								read += len(chunk)
+
+								if rate_limiter != None:
+									rate_limiter.transfer(url, len(chunk))
+
+								# Report progress
+								progress(url, read, size)
+					except requests.RequestException as e:
+						logger.error("RequestException downloading [{0:s}]: {1:s}".format(url, str(e)))
+						raise IncompleteDownload("Download incomplete [{0:s}]".format(url))
+					finally:
+						if metrics != None:
+							metrics.increment('bytes', read - start, url = url)
+
+				if read < size:
 					raise IncompleteDownload("Download incomplete [{0:s}]".format(url))
 
-			if read < size:
-				raise IncompleteDownload("Download incomplete [{0:s}]".format(url))
+				# The file is complete - move it into place
+				movefile(partfile, saveto)
 
-			if 'last-modified' in r.headers:
-				try:
-					os.utime(saveto, (time.time(), calendar.timegm(parsedate(r.headers['last-modified']))))
-				except Exception as e:
-					logger.warn("Failed to set modification times on [{0:s}]: {1:s}".format(saveto, e))
+				if os.path.isfile(infofile):
+					os.remove(infofile)
 
-			return r.headers
-		else:
-			raise ThreadHTTPError(url, r.status_code, r.reason)
+				if 'last-modified' in r.headers:
+					try:
+						os.utime(saveto, (time.time(), calendar.timegm(parsedate(r.headers['last-modified']))))
+					except Exception as e:
+						logger.warn("Failed to set modification times on [{0:s}]: {1:s}".format(saveto, e))
+
+				return r.headers
+			else:
+				raise ThreadHTTPError(url, r.status_code, r.reason)
+		finally:
+			# Release the connection back to the pool
+			r.close()
 	except:
-		if os.path.isfile(saveto):
-			os.remove(saveto)
+		e = sys.exc_info()[1]
+
+		# Keep the partial file if the download can be resumed from it, unless the file no longer exists
+		gone = isinstance(e, ThreadHTTPError) and e.code in (404, 410)
+		if not resume or gone or _read_part_info(infofile) == None:
+			_remove_part(partfile, infofile)
 
 		raise
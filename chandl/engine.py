@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import threading
+
+from Queue import Queue
+from collections import deque
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+class Task(object):
+	# A job submitted to the engine, which can be waited for
+
+	def __init__(self, func, args):
+		self._func = func
+		self._args = args
+
+		self._done = threading.Event()
+		self._result = None
+		self._error = None
+
+	def _run(self):
+		try:
+			self._result = self._func(*self._args)
+		except:
+			self._error = sys.exc_info()
+		finally:
+			self._done.set()
+
+	def done(self):
+		return self._done.is_set()
+
+	def wait(self, timeout=None):
+		# Return whether the task is done
+		self._done.wait(timeout)
+		return self._done.is_set()
+
+	def result(self):
+		# Wait for the task to finish, and return its result or raise its exception
+		# Waiting in short steps keeps the waiting thread responsive to signals
+		while not self.wait(0.5):
+			pass
+
+		if self._error != None:
+			exctype, value, tb = self._error
+			raise exctype, value, tb
+
+		return self._result
+
+class Workers(object):
+	# Runs tasks on up to a fixed number of threads, which are only started as they are needed
+
+	def __init__(self, size, name):
+		self.size = max(1, size)
+		self.name = name
+
+		self._queue = Queue()
+		self._threads = []
+		self._idle = 0
+		self._lock = threading.Lock()
+
+		# Set in the worker threads, so tasks can tell which workers they run on
+		self._local = threading.local()
+
+	def submit(self, task):
+		with self._lock:
+			self._queue.put(task)
+
+			if self._queue.qsize() > self._idle and len(self._threads) < self.size:
+				t = threading.Thread(target = self._worker, name = '{0:s}-{1:d}'.format(self.name, len(self._threads) + 1))
+				t.daemon = True
+				t.start()
+
+				self._threads.append(t)
+
+		return task
+
+	def current(self):
+		# Return whether the calling thread is one of these workers
+		return getattr(self._local, 'worker', False)
+
+	def _worker(self):
+		self._local.worker = True
+
+		while True:
+			with self._lock:
+				self._idle += 1
+
+			task = self._queue.get()
+
+			with self._lock:
+				self._idle -= 1
+
+			if task == None:
+				return
+
+			task._run()
+
+	def close(self):
+		with self._lock:
+			threads = list(self._threads)
+
+		for t in threads:
+			self._queue.put(None)
+
+		for t in threads:
+			t.join()
+
+class DownloadEngine(object):
+	# Runs the checks and file transfers of any number of downloaders on one shared set of threads
+	# The number of simultaneous checks and transfers is capped across all of them, however many threads are watched
+
+	def __init__(self, max_checks=16, max_transfers=32, host_transfers=None):
+		self.max_checks = max_checks
+		self.max_transfers = max_transfers
+
+		# Maximum number of simultaneous transfers from each host (None = no limit)
+		self.host_transfers = host_transfers
+
+		# Checks and transfers have separate workers, so checks waiting for their transfers can never starve them
+		self._checks = Workers(max_checks, 'check')
+		self._transfers = Workers(max_transfers, 'transfer')
+
+		# Number of transfers started for each host, and transfers waiting for one of them to finish
+		self._active = {}
+		self._waiting = {}
+		self._hosts_lock = threading.Lock()
+
+	def check(self, func, *args):
+		return self._checks.submit(Task(func, args))
+
+	def in_check(self):
+		# Return whether the calling thread is running a check, so anything it does in a check runs right away
+		return self._checks.current()
+
+	def transfer(self, func, url, *args):
+		# Transfer a file from the URL with func(url, *args), once its host has fewer than the maximum number of transfers running
+		task = Task(func, (url,) + args)
+		host = urlparse(url).hostname
+
+		with self._hosts_lock:
+			if self.host_transfers != None and self._active.get(host, 0) >= self.host_transfers:
+				self._waiting.setdefault(host, deque()).append(task)
+				return task
+
+			self._active[host] = self._active.get(host, 0) + 1
+
+		self._start_transfer(host, task)
+		return task
+
+	def _start_transfer(self, host, task):
+		def run():
+			try:
+				task._run()
+			finally:
+				self._transfer_done(host)
+
+		self._transfers.submit(Task(run, ()))
+
+	def _transfer_done(self, host):
+		# Start the next transfer waiting for the host, if any, in place of the one that finished
+		with self._hosts_lock:
+			waiting = self._waiting.get(host)
+
+			if waiting:
+				task = waiting.popleft()
+			else:
+				self._waiting.pop(host, None)
+				self._active[host] -= 1
+				return
+
+		self._start_transfer(host, task)
+
+	def close(self):
+		self._checks.close()
+		self._transfers.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
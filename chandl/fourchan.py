@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import cgi
+import json
+import logging
+
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+API_HOST = 'a.4cdn.org'
+MEDIA_HOST = 'i.4cdn.org'
+
+POST_TEMPLATE = (
+	u'<div class="postContainer replyContainer" id="pc{no:d}">'
+	u'<div class="sideArrows" id="sa{no:d}">&gt;&gt;</div>'
+	u'<div id="p{no:d}" class="post reply">'
+	u'<div class="postInfoM mobile" id="pim{no:d}"><span class="nameBlock"><span class="name">{name:s}</span>{trip:s}<br><span class="subject">{sub:s}</span></span>'
+	u'<span class="dateTime postNum" data-utc="{time:d}">{now:s} <a href="#p{no:d}" title="Link to this post">No.</a><a href="javascript:quote(\'{no:d}\');" title="Reply to this post">{no:d}</a></span></div>'
+	u'<div class="postInfo desktop" id="pi{no:d}"><input type="checkbox" name="{no:d}" value="delete"> <span class="subject">{sub:s}</span> '
+	u'<span class="nameBlock"><span class="name">{name:s}</span>{trip:s} </span> '
+	u'<span class="dateTime" data-utc="{time:d}">{now:s}</span> '
+	u'<span class="postNum desktop"><a href="#p{no:d}" title="Link to this post">No.</a><a href="javascript:quote(\'{no:d}\');" title="Reply to this post">{no:d}</a></span></div>'
+	u'{file:s}'
+	u'<blockquote class="postMessage" id="m{no:d}">{com:s}</blockquote>'
+	u'</div></div>'
+)
+
+FILE_TEMPLATE = (
+	u'<div class="file" id="f{no:d}">'
+	u'<div class="fileText" id="fT{no:d}">File: <a href="{src:s}" target="_blank">{filename:s}</a> ({size:s}, {w:d}x{h:d})</div>'
+	u'<a class="fileThumb" href="{src:s}" target="_blank"><img src="{thumb:s}" alt="{size:s}" data-md5="{md5:s}" style="height: {tn_h:d}px; width: {tn_w:d}px;">'
+	u'<div class="mFileInfo mobile">{size:s} {type:s}</div></a>'
+	u'</div>'
+)
+
+def api_url(thread_url, board, thread_id):
+	scheme = urlparse(thread_url).scheme or 'http'
+	return '{0:s}://{1:s}/{2:s}/thread/{3:s}.json'.format(scheme, API_HOST, board, thread_id)
+
+def catalog_url(board_url, board):
+	scheme = urlparse(board_url).scheme or 'http'
+	return '{0:s}://{1:s}/{2:s}/catalog.json'.format(scheme, API_HOST, board)
+
+def thread_url(board_url, board, thread_id):
+	scheme = urlparse(board_url).scheme or 'http'
+	return '{0:s}://boards.4chan.org/{1:s}/thread/{2:d}'.format(scheme, board, thread_id)
+
+def load_posts(filename):
+	with open(filename, 'rb') as f:
+		return json.load(f)['posts']
+
+def format_size(size):
+	if size >= 1024 * 1024:
+		return u'{0:.2f} MB'.format(size / (1024.0 * 1024.0))
+	elif size >= 1024:
+		return u'{0:d} KB'.format(size // 1024)
+
+	return u'{0:d} B'.format(size)
+
+def render_file(board, post):
+	if 'tim' not in post:
+		return u''
+
+	src = u'//{0:s}/{1:s}/{2:d}{3:s}'.format(MEDIA_HOST, board, post['tim'], post['ext'])
+	thumb = u'//{0:s}/{1:s}/{2:d}s.jpg'.format(MEDIA_HOST, board, post['tim'])
+	size = format_size(post.get('fsize', 0))
+
+	return FILE_TEMPLATE.format(
+		no = post['no'],
+		src = src,
+		thumb = thumb,
+		filename = cgi.escape(post.get('filename', u'') + post['ext'], True),
+		size = size,
+		type = post['ext'].lstrip('.').upper(),
+		w = post.get('w', 0),
+		h = post.get('h', 0),
+		tn_w = post.get('tn_w', 0),
+		tn_h = post.get('tn_h', 0),
+		md5 = post.get('md5', u''),
+	)
+
+def render_post(board, post):
+	# Render a reply in the same markup 4chan uses for its HTML pages
+	# Name, subject and comment are already HTML in the API
+	trip = post.get('trip', None)
+
+	return POST_TEMPLATE.format(
+		no = post['no'],
+		name = post.get('name', u''),
+		trip = u' <span class="postertrip">{0:s}</span>'.format(trip) if trip != None else u'',
+		sub = post.get('sub', u''),
+		time = post.get('time', 0),
+		now = post.get('now', u''),
+		file = render_file(board, post),
+		com = post.get('com', u''),
+	)
+
+def render_posts(board, posts):
+	return u''.join(render_post(board, p) for p in posts)
@@ -1,14 +1,47 @@
 # -*- coding: utf-8 -*-
 
+import re
+
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict
 
+RE_DIV_TAG = re.compile(r'<(/?)div\b([^>]*)>', re.IGNORECASE)
+RE_CLASS_ATTR = re.compile(r'''\bclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+RE_ID_ATTR = re.compile(r'''\bid\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+RE_RAW_TEXT = re.compile(r'(<(script|style|textarea|title)\b[^>]*>)(.*?)(</\2\s*>)', re.IGNORECASE | re.DOTALL)
+RE_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+
+RE_POST_NUMBER = re.compile(r'\d+')
+
+def post_number(id):
+	m = RE_POST_NUMBER.search(id or '')
+	if m == None:
+		return -1
+
+	return int(m.group(0))
+
+def _attr(regex, attrs):
+	m = regex.search(attrs)
+	if m == None:
+		return None
+
+	return m.group(1) or m.group(2) or m.group(3) or ''
+
+def _blank(m):
+	return ' ' * len(m.group(0))
+
+def _blank_raw_text(m):
+	return m.group(1) + ' ' * len(m.group(3)) + m.group(4)
+
 class ChanHelper(object):
 	THREAD_CLASS = 'thread'
 	POST_CLASS = 'postContainer'
 
 	def __init__(self, soup):
 		self.soup = soup
-		self.posts = {}
+
+		# Index of posts by id, built on first use
+		self._index = None
 
 	def get_thread(self):
 		try:
@@ -18,24 +51,100 @@ class ChanHelper(object):
 			self.thread = t
 			return t
 
+	@classmethod
+	def scan_posts(cls, html):
+		# Locate posts in raw HTML without parsing it
+		# Returns a list of (id, start, end) offsets, in document order, or None if the markup could not be followed
+		# Comments and raw text elements are blanked out first, so tags inside them are not mistaken for markup
+		markup = RE_RAW_TEXT.sub(_blank_raw_text, RE_COMMENT.sub(_blank, html))
+
+		posts = []
+		stack = []
+
+		for m in RE_DIV_TAG.finditer(markup):
+			if m.group(1):
+				if len(stack) == 0:
+					return None
+
+				id, start = stack.pop()
+				if start != None:
+					posts.append((id, start, m.end()))
+			else:
+				classes = (_attr(RE_CLASS_ATTR, m.group(2)) or '').split()
+
+				if cls.POST_CLASS in classes:
+					stack.append((_attr(RE_ID_ATTR, m.group(2)), m.start()))
+				else:
+					stack.append((None, None))
+
+		if len(stack) > 0:
+			return None
+
+		# Posts are appended as they are closed, so sort them by their start offset
+		posts.sort(key=lambda p: p[1])
+		return posts
+
+	def _build_index(self):
+		self._index = {}
+		self._ids = []
+		self._numbers = []
+
+		self._add_to_index(self.get_thread().find_all('div', {'class' : self.POST_CLASS}))
+
+	def _add_to_index(self, posts):
+		for post in posts:
+			id = post.attrs.get('id', None)
+			n = post_number(id)
+
+			# Keep posts ordered by number, so new posts end up after the ones they were inserted after
+			i = bisect_right(self._numbers, n)
+			self._ids.insert(i, id)
+			self._numbers.insert(i, n)
+			self._index[id] = post
+
+	def _position(self, id):
+		# Posts are numbered in increasing order, so their position can be found by bisection
+		i = bisect_left(self._numbers, post_number(id))
+		if i < len(self._ids) and self._ids[i] == id:
+			return i
+
+		return self._ids.index(id)
+
+	def post_ids(self):
+		if self._index == None:
+			self._build_index()
+
+		return self._ids
+
+	def has_post(self, id):
+		if self._index == None:
+			self._build_index()
+
+		return id in self._index
+
 	def get_post(self, id):
-		try:
-			return self.posts[id]
-		except KeyError:
-			p = self.get_thread().find('div', {'class' : self.POST_CLASS, 'id' : id})
-			self.posts[id] = p
-			return p
+		if self._index == None:
+			self._build_index()
+
+		return self._index.get(id, None)
 
 	def get_posts_after(self, id):
-		return self.get_post(id).find_next_siblings('div', {'class' : self.POST_CLASS})
+		ids = self.post_ids()
+		return [self._index[i] for i in ids[self._position(id) + 1:]]
 
 	def get_posts(self):
-		posts = OrderedDict()
-		for post in self.get_thread().find_all('div', {'class' : self.POST_CLASS}):
-			id = post.attrs.get('id', None)
-			posts[id] = post
+		return OrderedDict((id, self._index[id]) for id in self.post_ids())
 
-		return posts
+	def last_post_id(self):
+		return self.post_ids()[-1]
+
+	def find_last_shared_post(self, other):
+		# Find the last post that also exists in the other helper's thread
+		for id in reversed(self.post_ids()):
+			if other.has_post(id):
+				return id
+
+		return None
 
 	def get_first_post(self):
 		try:
@@ -52,6 +161,8 @@ class ChanHelper(object):
 			insert_after.insert_after(np)
 			insert_after = np
 
+		self._add_to_index(newposts)
+
 class TinyboardChanHelper(ChanHelper):
 	POST_CLASS = 'post'
 
@@ -71,3 +182,5 @@ class TinyboardChanHelper(ChanHelper):
 			insert_after.insert_after(br)
 			br.insert_after(np)
 			insert_after = np
+
+		self._add_to_index(newposts)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+from .utils import movefile
+
+class DownloadJournal(object):
+	def __init__(self, filename):
+		self.filename = filename
+
+		# Queued downloads that have not completed yet, as URLs by path relative to the thread folder
+		self.entries = OrderedDict()
+
+		self._lock = threading.Lock()
+
+		if os.path.isfile(filename):
+			self._load()
+
+	def _load(self):
+		with open(self.filename, 'rb') as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# Most likely a line that was only partially written when the process died
+					logger.warn("Ignoring invalid line in download journal [{0:s}].".format(self.filename))
+					continue
+
+				if entry['op'] == 'add':
+					self.entries[entry['path']] = entry['url']
+				elif entry['op'] == 'done':
+					self.entries.pop(entry['path'], None)
+
+		# Drop completed entries from the file
+		self.compact()
+
+	def __contains__(self, path):
+		return path in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def pending(self):
+		return [(url, path) for path, url in self.entries.items()]
+
+	def _append(self, entries, sync=False):
+		with open(self.filename, 'ab') as f:
+			for entry in entries:
+				f.write(json.dumps(entry) + '\n')
+
+			if sync:
+				f.flush()
+				os.fsync(f.fileno())
+
+	def add(self, items):
+		# Record (url, path) items as queued - this is synced to disk, as they would otherwise be lost if the process died
+		items = [(url, path) for url, path in items if path not in self.entries]
+		if len(items) == 0:
+			return
+
+		with self._lock:
+			for url, path in items:
+				self.entries[path] = url
+
+			self._append([{'op' : 'add', 'url' : url, 'path' : path} for url, path in items], sync = True)
+
+	def done(self, path):
+		with self._lock:
+			if self.entries.pop(path, None) == None:
+				return
+
+			# Not synced, as redoing a download that was actually completed is harmless
+			self._append([{'op' : 'done', 'path' : path}])
+
+	def compact(self):
+		# Rewrite the journal with only the pending entries, or remove it if there are none
+		with self._lock:
+			if len(self.entries) == 0:
+				if os.path.isfile(self.filename):
+					os.remove(self.filename)
+
+				return
+
+			tmpfile = '{0:s}.tmp'.format(self.filename)
+			with open(tmpfile, 'wb') as f:
+				for path, url in self.entries.items():
+					f.write(json.dumps({'op' : 'add', 'url' : url, 'path' : path}) + '\n')
+
+			movefile(tmpfile, self.filename)
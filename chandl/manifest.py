@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import threading
+import posixpath
+
+logger = logging.getLogger(__name__)
+
+from .utils import movefile, hash_file
+
+# Suffixes of files that are not (yet) complete downloads
+INCOMPLETE_SUFFIXES = ('.part', '.part.info', '.link', '.tmp')
+
+class DownloadManifest(object):
+	def __init__(self, filename):
+		self.filename = filename
+
+		# Completed files, as (size, md5) by path relative to the thread folder
+		self.entries = {}
+
+		self._lock = threading.Lock()
+
+		if os.path.isfile(filename):
+			self._load()
+
+	def exists(self):
+		return os.path.isfile(self.filename)
+
+	def _load(self):
+		with open(self.filename, 'rb') as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# Most likely a line that was only partially written when the process died
+					logger.warn("Ignoring invalid line in manifest [{0:s}].".format(self.filename))
+					continue
+
+				self.entries[entry['path']] = (entry['size'], entry['md5'])
+
+	def __contains__(self, path):
+		return path in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def add(self, path, size, digest):
+		line = json.dumps({'path' : path, 'size' : size, 'md5' : digest})
+
+		with self._lock:
+			self.entries[path] = (size, digest)
+
+			with open(self.filename, 'ab') as f:
+				f.write(line + '\n')
+
+	def add_file(self, path, filename, digest=None):
+		if digest == None:
+			digest = hash_file(filename)
+
+		self.add(path, os.path.getsize(filename), digest)
+
+	def rebuild(self, root, subdir='files'):
+		# Record every complete file found under the thread folder
+		entries = {}
+
+		for dirpath, dirnames, filenames in os.walk(os.path.join(root, subdir)):
+			for fn in filenames:
+				if fn.endswith(INCOMPLETE_SUFFIXES):
+					continue
+
+				filename = os.path.join(dirpath, fn)
+				path = posixpath.join(*os.path.relpath(filename, root).split(os.sep))
+				entries[path] = (os.path.getsize(filename), hash_file(filename))
+
+		with self._lock:
+			tmpfile = '{0:s}.tmp'.format(self.filename)
+			with open(tmpfile, 'wb') as f:
+				for path, (size, digest) in sorted(entries.items()):
+					f.write(json.dumps({'path' : path, 'size' : size, 'md5' : digest}) + '\n')
+
+			movefile(tmpfile, self.filename)
+			self.entries = entries
+
+		logger.info("Rebuilt manifest [{0:s}] with {1:d} files.".format(self.filename, len(entries)))
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+from .utils import atomic_write
+
+class NullTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+class NullMetrics(object):
+	# Does nothing, so instrumented code costs next to nothing when metrics are disabled
+	_timer = NullTimer()
+
+	def timer(self, phase, **labels):
+		return self._timer
+
+	def record(self, phase, seconds, **labels):
+		pass
+
+	def increment(self, name, value=1, **labels):
+		pass
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+class Timer(object):
+	def __init__(self, metrics, phase, labels):
+		self.metrics = metrics
+		self.phase = phase
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.time()
+
+		# Time spent in timers nested inside this one, which is not counted towards this phase
+		self.nested = 0.0
+
+		self.metrics._timers().append(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		elapsed = time.time() - self.start
+
+		timers = self.metrics._timers()
+		timers.pop()
+
+		if len(timers) > 0:
+			timers[-1].nested += elapsed
+
+		self.metrics.record(self.phase, elapsed - self.nested, **self.labels)
+
+class Metrics(object):
+	# Phases that are timed
+	PHASES = ('fetch', 'parse', 'merge', 'link_scan', 'download', 'save')
+
+	def __init__(self, events_file=None, prometheus_file=None):
+		# File to append every timing and counter event to, as JSON lines
+		if events_file != None:
+			self._events = open(events_file, 'ab')
+		else:
+			self._events = None
+
+		# Text file to write totals to in Prometheus' exposition format on every flush
+		self.prometheus_file = prometheus_file
+
+		# Totals of (count, seconds) by phase, and of counters by name
+		self.phases = dict((phase, (0, 0.0)) for phase in self.PHASES)
+		self.counters = {}
+
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	def _timers(self):
+		try:
+			return self._local.timers
+		except AttributeError:
+			self._local.timers = []
+			return self._local.timers
+
+	def _event(self, type, name, value, labels):
+		if self._events == None:
+			return
+
+		event = {'time' : time.time(), 'type' : type, 'name' : name, 'value' : value}
+		event.update(labels)
+
+		self._events.write(json.dumps(event) + '\n')
+		self._events.flush()
+
+	def timer(self, phase, **labels):
+		return Timer(self, phase, labels)
+
+	def record(self, phase, seconds, **labels):
+		with self._lock:
+			count, total = self.phases.get(phase, (0, 0.0))
+			self.phases[phase] = (count + 1, total + seconds)
+
+			self._event('timing', phase, seconds, labels)
+
+	def increment(self, name, value=1, **labels):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+			self._event('counter', name, value, labels)
+
+	def prometheus(self):
+		lines = [
+			'# HELP chandl_phase_seconds Time spent in each phase of checking threads.',
+			'# TYPE chandl_phase_seconds summary',
+		]
+
+		with self._lock:
+			for phase, (count, total) in sorted(self.phases.items()):
+				lines.append('chandl_phase_seconds_sum{{phase="{0:s}"}} {1:f}'.format(phase, total))
+				lines.append('chandl_phase_seconds_count{{phase="{0:s}"}} {1:d}'.format(phase, count))
+
+			for name, value in sorted(self.counters.items()):
+				lines.append('# TYPE chandl_{0:s}_total counter'.format(name))
+				lines.append('chandl_{0:s}_total {1:d}'.format(name, value))
+
+		return '\n'.join(lines) + '\n'
+
+	def flush(self):
+		if self.prometheus_file != None:
+			atomic_write(self.prometheus_file, [self.prometheus()])
+
+	def close(self):
+		self.flush()
+
+		if self._events != None:
+			self._events.close()
+			self._events = None
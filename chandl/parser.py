@@ -4,18 +4,29 @@ import os
 import logging
 import re
 import posixpath
+import base64
+import codecs
+import uuid
 
 from urlparse import urlparse, urljoin
 
 logger = logging.getLogger(__name__)
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
+from bs4.element import Tag
+from bs4.builder import builder_registry
+from bs4.dammit import EncodingDetector, UnicodeDammit
 
 from .exceptions import *
 from .helpers import *
 from .postprocess import *
+from .utils import atomic_write
+from .metrics import NullMetrics
 
 RE_LINK_IS_FILE = re.compile(r'/.*?\.[^/]')
+RE_FILE_SIZE = re.compile(r'([\d\.]+)\s*([KMG]?B)\b', re.I)
+
+FILE_SIZE_UNITS = { 'B' : 1, 'KB' : 1024, 'MB' : 1024 ** 2, 'GB' : 1024 ** 3 }
 
 class ThreadParser(object):
 	def __init__(self, url, filename=None, board_type=None, output_callback=None):
@@ -25,12 +36,16 @@ class ThreadParser(object):
 		if output_callback != None:
 			self._output = output_callback
 
-		self.link_patterns = [
-			re.compile('link.href'),
-			re.compile('script.src'),
-			re.compile('a.href'),
-			re.compile('img.src'),
-		]
+		# Records time spent parsing, merging, scanning links and saving
+		self.metrics = NullMetrics()
+
+		# Attributes containing links to handle, by tag name
+		self.link_attrs = {
+			'link' : ['href'],
+			'script' : ['src'],
+			'a' : ['href'],
+			'img' : ['src'],
+		}
 
 		self.board_type = None
 		self.merge = False
@@ -51,11 +66,39 @@ class ThreadParser(object):
 		self.links_local = {}
 		self.links_found = []
 
-		if filename == None:
-			self._soup = None
-		else:
-			with open(filename) as f:
-				self._soup = self._parse_html(f.read())
+		# Results of handling each link value, including links that were skipped
+		self._link_cache = {}
+
+		# MD5 hashes (hex) and approximate sizes of linked files, by local relative path, where the page exposes them
+		self.link_hashes = {}
+		self.link_sizes = {}
+
+		# Number of posts merged by the last update (None if the document was replaced rather than merged)
+		self.new_post_count = None
+
+		self._soup = None
+
+		# Saved document that has not been parsed yet
+		self._source = None
+
+		# Ids of the posts in the saved document, kept when the document is released
+		self._source_post_ids = None
+
+		# Save only the posts inserted since the last save, reusing the rest of the previously saved HTML
+		self.incremental_save = True
+
+		# Previously saved HTML as (filename, prefix chunks, suffix), split after the last post
+		self._saved = None
+		self._inserted_after = None
+
+		if filename != None:
+			if self.board_type != None:
+				# The saved document is only parsed once it is actually needed
+				self._source = filename
+			else:
+				# Parse it right away, as the board type may have to be identified from it
+				with open(filename) as f:
+					self._soup = self._parse_html(f.read())
 
 	def _output(self, text):
 		pass
@@ -71,7 +114,7 @@ class ThreadParser(object):
 			self.merge = True
 		elif n == 'mlpchan':
 			self.merge = True
-			self.link_patterns.append(re.compile('img.data-mature-src'))
+			self.link_attrs['img'].append('data-mature-src')
 			self.postprocessor = MLPChanPostProcessor()
 		else:
 			self._output("Unknown board type '{0:s}'.".format(n))
@@ -80,80 +123,298 @@ class ThreadParser(object):
 		self._output("Using board type '{0:s}'.".format(n))
 		self.board_type = n
 
-	def save(self, filename):
+	def _document(self):
+		# Parse the saved document, if that has not been done yet
+		if self._soup == None and self._source != None:
+			logger.info("Reading saved HTML from file: {0:s}...".format(self._source))
+			with open(self._source) as f:
+				html = f.read()
+
+			self._soup = self._parse_html(html)
+
+			# New posts can be spliced directly into the saved HTML, as long as its posts can be located
+			if self.merge and self.incremental_save:
+				posts = self.helper_factory.scan_posts(html)
+
+				if posts and [id for id, start, end in posts] == self._get_helper().post_ids():
+					end = posts[-1][2]
+					self._saved = (self._source, [html[:end]], html[end:])
+
+			self._source = None
+			self._source_post_ids = None
+
+		return self._soup
+
+	def release(self, filename):
+		# Drop the document (and everything derived from it) after it has been saved to filename, keeping only the post ids
+		# It is parsed from the saved file again when it is needed, which for a merging board is only when new posts arrive
+		if self._soup == None:
+			return
+
+		if self.merge:
+			self._source_post_ids = list(self._get_helper().post_ids())
+
+		# Break up the tree, so its memory is freed right away instead of whenever the garbage collector gets to it
+		self._soup.decompose()
+		self._soup = None
+		self._source = filename
+
 		try:
-			soupstr = str(self._soup)
-			with open(filename, 'wb') as f:
-				f.write(soupstr)
-		except:
-			# If save failed, but file (probably empty) was created, remove it so it doesn't block attempts at re-downloading
-			if os.path.isfile(filename):
-				os.remove(filename)
-			raise
+			del self._helper
+		except AttributeError:
+			pass
+
+		self._saved = None
+		self._inserted_after = None
+		self._link_cache = {}
+		self.link_hashes = {}
+		self.link_sizes = {}
+
+	def _mark_inserted(self, id):
+		# Remember where posts were first inserted since the document was last saved
+		if self._inserted_after == None:
+			self._inserted_after = id
+
+	def _serialize_incremental(self, filename):
+		if self._saved == None or self._saved[0] != filename:
+			return None
+
+		savedfile, prefix, suffix = self._saved
+
+		if self._inserted_after == None:
+			return prefix, suffix
+
+		helper = self._get_helper()
+		last = helper.get_post(helper.last_post_id())
+
+		# Serialize only what was inserted after the previously saved last post
+		node = helper.get_post(self._inserted_after)
+		region = []
+
+		while node is not last:
+			node = node.next_sibling
+			if node == None:
+				logger.info("Inserted posts could not be located. Saving the whole document.")
+				return None
+
+			region.append(serialize_node(node))
+
+		return prefix + region, suffix
+
+	def _serialize_full(self):
+		soup = self._document()
+
+		if not self.merge:
+			return None, str(soup)
+
+		helper = self._get_helper()
+		if len(helper.post_ids()) == 0:
+			return None, str(soup)
+
+		# Split the serialized document after the last post, so new posts can be inserted there on the next save
+		marker = NavigableString(u'chandl-save-marker-{0:s}'.format(uuid.uuid4().hex))
+		helper.get_post(helper.last_post_id()).insert_after(marker)
+
+		try:
+			soupstr = str(soup)
+		finally:
+			marker.extract()
+
+		prefix, suffix = soupstr.split(marker.encode('utf-8'), 1)
+		return [prefix], suffix
+
+	def save(self, filename, commit=True):
+		# If commit is False, the new file is left next to the old one for the caller to move into place
+		# Returns its name in that case, or None if there was nothing to write
+
+		# If the saved document was never parsed, it is unchanged
+		if self._soup == None and self._source == filename:
+			return None
+
+		with self.metrics.timer('save', thread = self.thread_url):
+			return self._save(filename, commit)
+
+	def _save(self, filename, commit):
+		serialized = None
+		if self.incremental_save:
+			serialized = self._serialize_incremental(filename)
+
+			# If nothing has changed since the document was saved, there is nothing to write
+			if serialized != None and self._inserted_after == None and os.path.isfile(filename):
+				return None
+
+		if serialized == None:
+			serialized = self._serialize_full()
+
+		prefix, suffix = serialized
+
+		if prefix == None:
+			tmpfile = atomic_write(filename, [suffix], commit)
+			self._saved = None
+		else:
+			tmpfile = atomic_write(filename, prefix + [suffix], commit)
+			self._saved = (filename, prefix, suffix)
+
+		self._inserted_after = None
+
+		return tmpfile
 
 	def update(self, filename):
 		logger.info("Reading original HTML from file: {0:s}...".format(filename))
 		with open(filename, 'rb') as f:
 			html = f.read()
 
-		# Parse new HTML
-		newsoup = self._parse_html(html)
-
 		# Attempt to merge with previous download, if applicable
-		if self.merge and self._soup != None:
-			newtags = self._merge(newsoup)
+		if self.merge and self.has_document():
+			with self.metrics.timer('merge', thread = self.thread_url):
+				# Try parsing only the new posts first, and fall back to parsing the whole page
+				newtags = self._merge_incremental(html)
+				if newtags == None:
+					newtags = self._merge(self._parse_html(html))
+
+			self.new_post_count = len(newtags)
 		else:
-			self._soup = newsoup
+			self._soup = self._parse_html(html)
+			self._source = None
+
+			# The document was replaced, so nothing saved before can be reused
+			self._saved = None
+			self._inserted_after = None
 			self.postprocessor.process_document(self._soup)
 			newtags = [self._soup]
+			self.new_post_count = None
 
 		# Find and process links
-		for t in newtags:
-			self._find_links(t)
-			self.postprocessor.process_new_posts(newtags)
+		with self.metrics.timer('link_scan', thread = self.thread_url):
+			for t in newtags:
+				self._find_links(t)
 
 	def _merge(self, newsoup):
 		logger.info("Merging...")
 
 		# Get main helper
-		try:
-			helper = self._helper
-		except AttributeError:
-			self._helper = self.helper_factory(self._soup)
-			helper = self._helper
+		helper = self._get_helper()
 
 		# Instantiate helper for the new thread
 		newhelper = self.helper_factory(newsoup)
 
 		# Get last post of main thread
-		prevposts = helper.get_posts()
-		newposts = newhelper.get_posts()
-		previous_last_post_id = prevposts.keys()[-1]
+		previous_last_post_id = helper.last_post_id()
 
-		# Find first new post that also exists in the old thread,
+		# Find last post of main thread that also exists in the new thread,
 		# taking into account that the last previous post may have been deleted
-		while True:
-			try:
-				lpid, lp = prevposts.popitem()
-			except KeyError:
-				raise Exception("No common post could be found. This should not be possible, and should never happen.")
-
-			if lpid in newposts:
-				break
-
-		last_shared_post_id = lpid
+		last_shared_post_id = helper.find_last_shared_post(newhelper)
+		if last_shared_post_id == None:
+			raise Exception("No common post could be found. This should not be possible, and should never happen.")
 
 		# Get all new posts
 		newposts = newhelper.get_posts_after(last_shared_post_id)
 		count = len(newposts)
 
 		# Insert new posts after previous last post
+		self._mark_inserted(previous_last_post_id)
 		helper.insert_posts_after(previous_last_post_id, newposts)
 
 		self._output("{0:d} new posts merged.".format(count))
 
 		return newposts
 
+	def _merge_incremental(self, html):
+		# Locate the posts in the new page without parsing it
+		newposts = self.helper_factory.scan_posts(html)
+		if not newposts:
+			logger.info("Could not locate posts in the new page.")
+			return None
+
+		prev_ids = self._post_ids()
+		new_index = dict((id, i) for i, (id, start, end) in enumerate(newposts))
+
+		# Find the last previous post that also exists in the new page,
+		# taking into account that the last previous post may have been deleted
+		for lpid in reversed(prev_ids):
+			if lpid in new_index:
+				break
+		else:
+			logger.info("No common post found in the new page.")
+			return None
+
+		newposts = newposts[new_index[lpid] + 1:]
+
+		if len(newposts) == 0:
+			self._output("0 new posts merged.")
+			return []
+
+		logger.info("Merging...")
+
+		# Parse only the part of the page containing the new posts
+		# The part has no encoding declaration of its own, so it is decoded with the encoding of the whole page first
+		with self.metrics.timer('parse', thread = self.thread_url):
+			part = html[newposts[0][1]:newposts[-1][2]].decode(html_encoding(html), 'replace')
+			fragment = parse_html(part, self._backends(html))
+		nodes = fragment.find_all('div', {'class' : self.helper_factory.POST_CLASS})
+
+		# If the parsed posts are not the ones that were located, the page could not be followed correctly
+		if [n.get('id') for n in nodes] != [p[0] for p in newposts]:
+			logger.info("Posts in the new page could not be located correctly.")
+			return None
+
+		# Insert new posts after previous last post
+		self._mark_inserted(prev_ids[-1])
+		self._get_helper().insert_posts_after(prev_ids[-1], nodes)
+
+		self._output("{0:d} new posts merged.".format(len(nodes)))
+
+		return nodes
+
+	def _get_helper(self):
+		try:
+			return self._helper
+		except AttributeError:
+			self._helper = self.helper_factory(self._document())
+			return self._helper
+
+	def has_document(self):
+		return self._soup != None or self._source != None
+
+	def _post_ids(self):
+		# If the saved document has not been parsed, get the post ids from its raw HTML instead
+		if self._soup == None and self._source_post_ids != None:
+			return self._source_post_ids
+
+		if self._soup == None and self._source != None:
+			with open(self._source) as f:
+				posts = self.helper_factory.scan_posts(f.read())
+
+			if posts:
+				return [id for id, start, end in posts]
+
+		return self._get_helper().post_ids()
+
+	def last_post_id(self):
+		return self._post_ids()[-1]
+
+	def update_posts(self, html):
+		# Parse a fragment containing only new posts, and append them to the document
+		with self.metrics.timer('parse', thread = self.thread_url):
+			fragment = BeautifulSoup(html, 'html.parser')
+
+		with self.metrics.timer('merge', thread = self.thread_url):
+			newposts = fragment.find_all('div', {'class' : self.helper_factory.POST_CLASS}, recursive=False)
+
+			# The document is only needed if there is something to add to it
+			if len(newposts) > 0:
+				last_post_id = self.last_post_id()
+				self._mark_inserted(last_post_id)
+				self._get_helper().insert_posts_after(last_post_id, newposts)
+
+		self.new_post_count = len(newposts)
+		self._output("{0:d} new posts merged.".format(self.new_post_count))
+
+		# Find and process links
+		with self.metrics.timer('link_scan', thread = self.thread_url):
+			for t in newposts:
+				self._find_links(t)
+
 	def _handle(self, link):
 		# Construct full link
 		abslink = urljoin(self.thread_url, link)
@@ -185,54 +446,173 @@ class ThreadParser(object):
 		return relpath
 
 	def _find_links(self, soup):
+		# Rewrite links and post-process new tags in a single pass
+		link_attrs = self.link_attrs
+		process_tag = self.postprocessor.process_tag
+
 		for tag in soup.find_all(True):
-			for name, values in tag.attrs.items():
-				if isinstance(values, basestring):
-					values = [values]
-				for v in values:
-					matched = False
-
-					# Check if tag/attribute/value matches any of the valid patterns
-					matchstr = u'{tag:s}.{attr:s}={value:s}'.format(tag = tag.name, attr = name, value = v)
-
-					for p in self.link_patterns:
-						if p.match(matchstr) != None:
-							# We found a match - doesn't matter if any other patterns match, so we break out of the loop
-							matched = True
-							break
-
-					# If no patterns matched, move on to next value
-					if not matched:
+			attrs = link_attrs.get(tag.name)
+
+			if attrs != None:
+				for name in attrs:
+					values = tag.attrs.get(name)
+					if values == None:
 						continue
 
-					newvalue = self._handle(v)
+					if isinstance(values, basestring):
+						newvalue = self._handle_cached(values)
+					else:
+						newvalue = [self._handle_cached(v) for v in values]
+						if None in newvalue:
+							newvalue = None
+
 					if newvalue != None:
 						tag[name] = newvalue
 
-	def _parse_html(self, html):
+			# Thumbnails may carry the MD5 hash and size of the file they link to
+			if 'data-md5' in tag.attrs:
+				self._record_file_info(tag)
+
+			if process_tag != None:
+				process_tag(tag)
+
+	def _record_file_info(self, tag):
+		parent = tag.parent
+		if parent == None or parent.name != 'a' or 'href' not in parent.attrs:
+			return
+
+		# The link has already been rewritten to its local path at this point
+		href = parent['href']
+
+		# The thumbnail's alt text is the file size as displayed (ie. "293 KB")
+		m = RE_FILE_SIZE.search(tag.get('alt', ''))
+		if m != None:
+			self.link_sizes[href] = int(float(m.group(1)) * FILE_SIZE_UNITS[m.group(2).upper()])
+
+		try:
+			digest = base64.b64decode(tag['data-md5']).encode('hex')
+		except (TypeError, ValueError):
+			logger.debug("Invalid MD5 hash: {0:s}".format(tag['data-md5']))
+			return
+
+		self.link_hashes[href] = digest
+
+	def _handle_cached(self, link):
+		try:
+			return self._link_cache[link]
+		except KeyError:
+			newvalue = self._handle(link)
+			self._link_cache[link] = newvalue
+			return newvalue
+
+	def _backends(self, html):
 		try:
-			parser = self._html_parser
+			return self._html_parsers
 		except AttributeError:
-			parser = select_html_parser(html)
-			self._html_parser = parser
+			self._html_parsers = select_html_parsers(html)
+			return self._html_parsers
 
-		logger.debug("Using HTML parser '{0:s}'.".format(parser))
-		soup = BeautifulSoup(html, parser)
+	def _parse_html(self, html):
+		with self.metrics.timer('parse', thread = self.thread_url):
+			soup = parse_html(html, self._backends(html))
 
 		if self.board_type == None and self._soup == None:
 			bt = identify_board_type(soup)
 			if bt != None:
-				self.set_board_type(bt)
+				self._set_board_type(bt)
 
 		return soup
 
-def select_html_parser(html):
-	if re.match(r'<!DOCTYPE HTML.*?(HTML 4\.01|XHTML 1\.0).*?>', html, re.IGNORECASE) != None:
+def serialize_node(node):
+	# Serialize a node the same way it is serialized as part of the whole document
+	if isinstance(node, Tag):
+		return node.decode().encode('utf-8')
+
+	return node.output_ready().encode('utf-8')
+
+RE_OLD_DOCTYPE = re.compile(r'<!DOCTYPE HTML.*?(HTML 4\.01|XHTML 1\.0).*?>', re.IGNORECASE)
+RE_START_TAG = re.compile(r'<[a-zA-Z]')
+RE_RAW_TEXT = re.compile(r'(<(script|style|textarea|title)\b[^>]*>).*?(</\2\s*>)', re.IGNORECASE | re.DOTALL)
+RE_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+
+class HTMLParserBackend(object):
+	# Name of the BeautifulSoup tree builder feature to use
+	name = None
+
+	def available(self):
+		return builder_registry.lookup(self.name) != None
+
+	def parse(self, html):
+		return BeautifulSoup(html, self.name)
+
+	def accepts(self, html, soup):
+		return True
+
+class PythonHTMLParserBackend(HTMLParserBackend):
+	name = 'html.parser'
+
+class HTML5LibBackend(HTMLParserBackend):
+	name = 'html5lib'
+
+class LXMLBackend(HTMLParserBackend):
+	name = 'lxml'
+
+	def accepts(self, html, soup):
+		# lxml stops at NUL characters
+		if '\0' in html:
+			return False
+
+		# lxml silently drops markup it cannot make sense of, which html5lib would have kept
+		# If the resulting tree has fewer tags than the document has start tags, something was lost
+		# Contents of comments and raw text elements such as scripts are not markup, so they are not counted
+		markup = RE_RAW_TEXT.sub(r'\1\3', RE_COMMENT.sub('', html))
+		return len(soup.find_all(True)) >= len(RE_START_TAG.findall(markup))
+
+# Parser backends to try, in order of preference, for HTML5 documents
+HTML5_PARSERS = [
+	LXMLBackend(),
+	HTML5LibBackend(),
+]
+
+# Parser backends to try for old HTML 4.01 and XHTML 1.0 documents
+OLD_HTML_PARSERS = [
+	PythonHTMLParserBackend(),
+]
+
+def select_html_parsers(html):
+	if RE_OLD_DOCTYPE.match(html) != None:
 		# Old XHTML or HTML 4 detected - use Python html parser
-		return 'html.parser'
+		candidates = OLD_HTML_PARSERS
+	else:
+		# Since it wasn't old HTML, assume it is HTML5
+		candidates = HTML5_PARSERS
+
+	return [b for b in candidates if b.available()]
+
+def select_html_parser(html):
+	return select_html_parsers(html)[0].name
+
+def html_encoding(html):
+	# Encoding declared by a document, or failing that the one it appears to be in
+	encoding = EncodingDetector.find_declared_encoding(html, is_html = True)
+
+	try:
+		codecs.lookup(encoding or '')
+	except LookupError:
+		encoding = UnicodeDammit(html, is_html = True).original_encoding
+
+	return encoding or 'utf-8'
+
+def parse_html(html, backends):
+	# Use the first backend whose result is acceptable, falling back to the last one if none are
+	for backend in backends:
+		logger.debug("Using HTML parser '{0:s}'.".format(backend.name))
+		soup = backend.parse(html)
+
+		if backend is backends[-1] or backend.accepts(html, soup):
+			return soup
 
-	# Since it wasn't old HTML, assume it is HTML5 - use html5lib
-	return 'html5lib'
+		logger.info("HTML parser '{0:s}' could not parse the document correctly. Falling back.".format(backend.name))
 
 def identify_board_type(soup):
 	if soup.find('a', {'href' : 'http://tinyboard.org/'}) != None:
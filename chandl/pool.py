@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import threading
+
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+from .exceptions import *
+
+class DownloadPool(object):
+	def __init__(self, workers, host_workers=None):
+		self.workers = max(1, workers)
+		self.host_workers = host_workers
+
+	def run(self, queue, fetch, cancel_callback=None, progress_callback=None):
+		cond = threading.Condition()
+
+		state = {
+			'error': None,
+			'cancelled': False,
+			'completed': 0,
+		}
+
+		total = len(queue)
+
+		# Number of active downloads per host
+		active = {}
+
+		# Progress of in-flight downloads, keyed by URL
+		inflight = {}
+
+		def iscancelling():
+			if state['cancelled']:
+				return True
+
+			if callable(cancel_callback) and cancel_callback():
+				state['cancelled'] = True
+
+			return state['cancelled']
+
+		def report(url):
+			if not callable(progress_callback):
+				return
+
+			read, size = 0, 0
+			for r, s in inflight.values():
+				if s > 0:
+					read += r
+					size += s
+
+			if size > 0:
+				prg = (float(read) / size) * 100
+			else:
+				prg = -1
+
+			progress_callback(prg, state['completed'] + len(inflight), total, url)
+
+		def progress(url, read, size):
+			with cond:
+				inflight[url] = (read, size)
+				report(url)
+
+		def take():
+			# Take the first queued item whose host has not reached its concurrency cap
+			for i, item in enumerate(queue):
+				host = urlparse(item[0]).netloc
+
+				if self.host_workers == None or active.get(host, 0) < self.host_workers:
+					del queue[i]
+					active[host] = active.get(host, 0) + 1
+					inflight[item[0]] = (0, 0)
+					return host, item
+
+			return None, None
+
+		def worker():
+			while True:
+				with cond:
+					while True:
+						if state['error'] != None or iscancelling() or len(queue) == 0:
+							return
+
+						host, item = take()
+						if item != None:
+							break
+
+						# All queued items are for hosts that are at their cap - wait for a slot to free up
+						cond.wait(0.5)
+
+				url, saveto = item
+
+				try:
+					fetch(url, saveto, progress)
+				except:
+					with cond:
+						# Put the failed item back so it will be retried on the next run
+						queue.appendleft(item)
+
+						if state['error'] == None:
+							state['error'] = sys.exc_info()
+				finally:
+					with cond:
+						active[host] -= 1
+						inflight.pop(url, None)
+						state['completed'] += 1
+						cond.notify_all()
+
+		threads = [threading.Thread(target=worker) for i in range(min(self.workers, total))]
+		for t in threads:
+			t.daemon = True
+			t.start()
+
+		# Wait for workers to finish
+		# Joining with a timeout keeps the main thread responsive to signals
+		for t in threads:
+			while t.is_alive():
+				t.join(0.5)
+
+				with cond:
+					iscancelling()
+
+		if state['error'] != None:
+			exctype, value, tb = state['error']
+			raise exctype, value, tb
+
+		if state['cancelled'] and len(queue) > 0:
+			raise CancelException
@@ -3,6 +3,9 @@
 import re
 
 class NullPostProcessor(object):
+	# Called for every tag in new posts while links are being processed, or None if not needed
+	process_tag = None
+
 	def process_document(self, soup):
 		pass
 	def process_new_posts(self, posts):
@@ -31,6 +34,10 @@ class MLPChanPostProcessor(object):
 
 	def process_new_posts(self, posts):
 		for post in posts:
-			# Change mature-spoilered thumbnails to the real thumbnails
-			for tag in post.find_all('img', {'class' : 'postimg', self.MATURE_SRC_TAG : True}):
-				tag['src'] = tag[self.MATURE_SRC_TAG]
+			for tag in post.find_all('img'):
+				self.process_tag(tag)
+
+	def process_tag(self, tag):
+		# Change mature-spoilered thumbnails to the real thumbnails
+		if tag.name == 'img' and self.MATURE_SRC_TAG in tag.attrs and 'postimg' in tag.get('class', []):
+			tag['src'] = tag[self.MATURE_SRC_TAG]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import re
+import posixpath
+
+from urlparse import urlparse
+
+# Download tiers, in the order they are downloaded
+TIER_PAGE = 0
+TIER_THUMBNAIL = 1
+TIER_MEDIA = 2
+
+# Extensions of files needed to display the page itself
+PAGE_EXTENSIONS = frozenset(['.css', '.js', '.ico'])
+
+# Images of the page itself are kept in a folder of static files, apart from the files posted in threads
+RE_STATIC = re.compile(r'^/(?:static|image|images|img|css|js)/')
+
+# Thumbnails are named "<timestamp>s.jpg" on 4chan, and kept in a "thumb" folder on Tinyboard-based sites
+RE_THUMBNAIL = re.compile(r'(?:/\d+s\.jpg|/thumb/[^/]+)$')
+
+def is_static_asset(url):
+	# Return whether the file is part of the site rather than of the thread, so it is the same in every thread
+	path = urlparse(url).path
+	return posixpath.splitext(path)[1].lower() in PAGE_EXTENSIONS or RE_STATIC.match(path) != None
+
+def file_tier(url):
+	if is_static_asset(url):
+		return TIER_PAGE
+
+	if RE_THUMBNAIL.search(urlparse(url).path) != None:
+		return TIER_THUMBNAIL
+
+	return TIER_MEDIA
+
+def default_priority(url, size):
+	# Return the sort key of a queued download - page assets first, then thumbnails, then media
+	# Within each tier smaller files go first, and files of unknown size last
+	return file_tier(url), size if size != None else sys.maxint
+
+def document_order(url, size):
+	# Keep downloads in the order they were found
+	return 0
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket(object):
+	def __init__(self, rate, burst=None):
+		# Tokens added per second, and the maximum number of tokens that can be saved up
+		self.rate = float(rate)
+		self.burst = float(burst if burst != None else max(rate, 1))
+
+		self.tokens = self.burst
+		self.updated = None
+
+		self._lock = threading.Lock()
+
+	def reserve(self, amount, now):
+		# Take tokens from the bucket, and return the number of seconds until they are actually available
+		# The bucket is allowed to go into debt, so concurrent callers queue up behind each other
+		with self._lock:
+			if self.updated != None:
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+
+			self.updated = now
+			self.tokens -= amount
+
+			if self.tokens >= 0:
+				return 0
+
+			return -self.tokens / self.rate
+
+class RateLimiter(object):
+	KINDS = ('requests', 'bytes')
+
+	def __init__(self, bytes_per_second=None, requests_per_second=None, host_bytes_per_second=None, host_requests_per_second=None):
+		self._lock = threading.Lock()
+
+		# Limits shared by all hosts
+		self._global = self._new_buckets(bytes_per_second, requests_per_second)
+
+		# Default limits for each host, and any host-specific overrides
+		self.host_limits = (host_bytes_per_second, host_requests_per_second)
+		self._host_overrides = {}
+		self._hosts = {}
+
+		# Total number of seconds spent waiting for each kind of limit, overall and per host
+		self.waited = dict((kind, 0.0) for kind in self.KINDS)
+		self.host_waited = {}
+
+	def _sleep(self, seconds):
+		time.sleep(seconds)
+
+	def _new_buckets(self, bytes_per_second, requests_per_second):
+		buckets = {}
+
+		if bytes_per_second:
+			buckets['bytes'] = TokenBucket(bytes_per_second)
+
+		if requests_per_second:
+			buckets['requests'] = TokenBucket(requests_per_second)
+
+		return buckets
+
+	def set_host_limits(self, host, bytes_per_second=None, requests_per_second=None):
+		logger.debug("Using rate limits {0} bytes/s, {1} requests/s for host '{2:s}'.".format(bytes_per_second, requests_per_second, host))
+
+		with self._lock:
+			self._host_overrides[host] = (bytes_per_second, requests_per_second)
+			self._hosts.pop(host, None)
+
+	def _host_buckets(self, host):
+		with self._lock:
+			if host not in self._hosts:
+				self._hosts[host] = self._new_buckets(*self._host_overrides.get(host, self.host_limits))
+
+			return self._hosts[host]
+
+	def _take(self, url, kind, amount):
+		host = urlparse(url).netloc
+		now = time.time()
+
+		wait = 0
+		for buckets in (self._global, self._host_buckets(host)):
+			if kind in buckets:
+				wait = max(wait, buckets[kind].reserve(amount, now))
+
+		if wait > 0:
+			with self._lock:
+				self.waited[kind] += wait
+
+				host_waited = self.host_waited.setdefault(host, dict((k, 0.0) for k in self.KINDS))
+				host_waited[kind] += wait
+
+			self._sleep(wait)
+
+		return wait
+
+	def request(self, url):
+		# Wait until a request to the URL is allowed
+		return self._take(url, 'requests', 1)
+
+	def transfer(self, url, size):
+		# Account for bytes transferred from the URL, waiting if the bandwidth limit has been exceeded
+		return self._take(url, 'bytes', size)
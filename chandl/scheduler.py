@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import time
+import heapq
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+from requests import ConnectionError
+
+from .exceptions import *
+
+class IncrementalInterval(object):
+	def __init__(self, interval=30, auto_increment=5, max_auto_increment=90):
+		self.interval = interval
+		self.auto_increment = auto_increment
+		self.max_auto_increment = max_auto_increment
+
+		self.checks_since_last_update = 0
+
+	def observe(self, new_posts, now):
+		if new_posts == 0:
+			self.checks_since_last_update += 1
+		else:
+			self.checks_since_last_update = 0
+
+	def next_interval(self):
+		return self.interval + min(self.auto_increment * self.checks_since_last_update, self.max_auto_increment)
+
+class AdaptiveInterval(object):
+	def __init__(self, interval=30, min_interval=10, max_interval=600, target_posts=1.0, smoothing=0.5, max_change=2.0):
+		self.interval = interval
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+
+		# Number of new posts to aim for per check
+		self.target_posts = target_posts
+
+		# Weight of the latest observation in the moving average - higher values react faster
+		self.smoothing = smoothing
+
+		# Most the interval can grow or shrink by in one check, as a factor
+		self.max_change = max_change
+
+		# Estimated post rate (posts per second), starting out as the rate the configured interval is right for
+		# Checks without new posts then slow it down gradually rather than all at once
+		self.rate = float(target_posts) / interval
+		self.last_observed = None
+
+		self.current = min(max(interval, min_interval), max_interval)
+
+	def observe(self, new_posts, now):
+		if new_posts != None and self.last_observed != None:
+			elapsed = now - self.last_observed
+
+			if elapsed > 0:
+				sample = float(new_posts) / elapsed
+				self.rate = self.smoothing * sample + (1 - self.smoothing) * self.rate
+
+				if self.rate > 0:
+					interval = self.target_posts / self.rate
+				else:
+					interval = self.max_interval
+
+				interval = min(max(interval, self.current / self.max_change), self.current * self.max_change)
+				self.current = min(max(interval, self.min_interval), self.max_interval)
+
+		self.last_observed = now
+
+	def next_interval(self):
+		return self.current
+
+class ThreadWatch(object):
+	def __init__(self, downloader, interval=30, auto_increment=5, max_auto_increment=90, retry=10, retry_increment=120, force=False, output_callback=None, report_callback=None, policy=None):
+		self.downloader = downloader
+
+		# Policy deciding the interval between successful checks
+		if policy != None:
+			self.policy = policy
+		else:
+			self.policy = IncrementalInterval(interval, auto_increment, max_auto_increment)
+
+		self.max_retries = retry
+		self.retry_increment = retry_increment
+
+		if output_callback != None:
+			self._output = output_callback
+
+		if report_callback != None:
+			self._report = report_callback
+
+		# Force re-download on the first check only
+		self.force = force
+
+		self.retries = 0
+		self.last_check = None
+		self.last_update = None
+
+	def _output(self, text):
+		pass
+
+	def _report(self, text):
+		pass
+
+	@property
+	def url(self):
+		return self.downloader.thread_url
+
+	def check(self):
+		# Check the thread for updates once, and return whether it should be checked again
+		self._report("Checking thread [{0:s}] for updates...".format(self.url))
+
+		try:
+			self.downloader.download(force = self.force)
+			self.last_update = time.time()
+			self.policy.observe(self.downloader.new_posts, self.last_update)
+		except CancelException:
+			self._output("Download cancelled.")
+			return False
+		except ThreadNotModified as e:
+			self._output(e)
+			self.policy.observe(0, time.time())
+		except ThreadNotFound as e:
+			self._output(e)
+			return False
+		except (ThreadHTTPError, ConnectionError, IncompleteDownload) as e:
+			self._output(e)
+
+			if self.retries < self.max_retries:
+				self.retries += 1
+				self.downloader.metrics.increment('retries', thread = self.url)
+				return True
+
+			return False
+		finally:
+			# Reset force after first run
+			self.force = False
+
+			# Set last checked time
+			self.last_check = time.time()
+
+			self.downloader.metrics.flush()
+
+		# Check succeeded, reset retry count
+		self.retries = 0
+		return True
+
+	def next_interval(self):
+		if self.retries == 0:
+			return self.policy.next_interval()
+
+		return self.retry_increment * self.retries
+
+	def next_check(self):
+		if self.last_check == None:
+			return time.time()
+
+		return self.last_check + self.next_interval()
+
+class Scheduler(object):
+	def __init__(self, cancel_callback=None, wait_callback=None, concurrency=1, persistent=False, engine=None):
+		if cancel_callback != None:
+			self._iscancelling = cancel_callback
+
+		if wait_callback != None:
+			self._wait = wait_callback
+
+		# Number of watches to check at the same time, each in its own thread
+		self.concurrency = concurrency
+
+		# Engine to run the checks on instead of threads of their own (None = start a thread for each check)
+		self.engine = engine
+
+		# Keep running when there is nothing left to check, waiting for watches to be added from elsewhere
+		self.persistent = persistent
+
+		# Heap of (due time, sequence number, watch) - the sequence number keeps ordering stable for equal due times
+		self._heap = []
+		self._seq = itertools.count()
+
+		# Watches being checked, by the time they are due again if they were added back during the check
+		# (None = their own next check, False = removed during the check)
+		self._running = {}
+		self._error = None
+
+		# Called with watches removed during their check, once the check is done
+		self._retiring = {}
+
+		# Watches are added and removed by other watches' checks, which may run in other threads
+		self._cond = threading.Condition(threading.RLock())
+
+	def _iscancelling(self):
+		return False
+
+	def _wait(self, watch, remaining):
+		pass
+
+	def __len__(self):
+		with self._cond:
+			return len(self._heap) + len(self._running)
+
+	def __contains__(self, watch):
+		with self._cond:
+			return watch in self._running or any(e[2] is watch for e in self._heap)
+
+	@property
+	def watches(self):
+		# Watches in the order they are due, followed by those being checked (except those removed during their check)
+		with self._cond:
+			return [w for due, seq, w in sorted(self._heap)] + [w for w, due in self._running.items() if due is not False]
+
+	def due(self, watch):
+		# Return the time the watch is due to be checked (None if it is being checked, or not scheduled)
+		with self._cond:
+			for due, seq, w in self._heap:
+				if w is watch:
+					return due
+
+			return None
+
+	def _push(self, watch, due):
+		if due == None:
+			due = watch.next_check()
+
+		heapq.heappush(self._heap, (due, next(self._seq), watch))
+
+	def add(self, watch, due=None):
+		with self._cond:
+			if watch in self._running:
+				# Being checked right now, so it is added back once the check is done
+				self._running[watch] = due
+			else:
+				self._push(watch, due)
+
+			self._cond.notify_all()
+
+	def remove(self, watch, retire_callback=None):
+		# retire_callback is called with the watch once it is no longer being checked - right away, or when its check is done
+		with self._cond:
+			self._heap = [e for e in self._heap if e[2] is not watch]
+			heapq.heapify(self._heap)
+
+			if watch in self._running:
+				self._running[watch] = False
+
+				if retire_callback != None:
+					self._retiring[watch] = retire_callback
+
+				return
+
+		if retire_callback != None:
+			retire_callback(watch)
+
+	def run(self):
+		if self.concurrency > 1:
+			self._run_concurrently()
+			return
+
+		while not self._iscancelling():
+			with self._cond:
+				if len(self._heap) == 0:
+					if not self.persistent:
+						break
+
+					watch, remaining = None, 1
+				else:
+					due, seq, watch = self._heap[0]
+					remaining = due - time.time()
+
+					if remaining <= 0:
+						heapq.heappop(self._heap)
+						self._running[watch] = None
+
+			if remaining > 0:
+				if watch != None:
+					self._wait(watch, remaining)
+
+				# Sleep in short steps, so cancellation is noticed promptly
+				try:
+					time.sleep(min(remaining, 1))
+				except IOError:
+					# User pressed CTRL-C, break loop
+					logger.info("Sleep interrupted. Terminating.")
+					break
+
+				continue
+
+			self._check(watch)
+
+			if self._error != None:
+				exctype, value, tb = self._error
+				self._error = None
+				raise exctype, value, tb
+
+	def _run_concurrently(self):
+		# Start checks as they become due, as long as fewer than the maximum number are running
+		with self._cond:
+			try:
+				while not self._iscancelling():
+					if self._error != None:
+						exctype, value, tb = self._error
+						self._error = None
+						raise exctype, value, tb
+
+					if len(self._heap) == 0 and len(self._running) == 0 and not self.persistent:
+						break
+
+					remaining = 1
+
+					if len(self._heap) > 0 and len(self._running) < self.concurrency:
+						due, seq, watch = self._heap[0]
+						remaining = due - time.time()
+
+						if remaining <= 0:
+							heapq.heappop(self._heap)
+							self._running[watch] = None
+
+							if self.engine != None:
+								self.engine.check(self._check, watch)
+							else:
+								t = threading.Thread(target = self._check, args = (watch,))
+								t.daemon = True
+								t.start()
+
+							continue
+
+						self._wait(watch, remaining)
+
+					# Wait for the next watch to become due or a check to finish, in short steps so cancellation is noticed promptly
+					self._cond.wait(min(remaining, 1))
+			except IOError:
+				# User pressed CTRL-C, break loop
+				logger.info("Sleep interrupted. Terminating.")
+
+			# Let the checks already started finish - they stop early by themselves if cancelled
+			while len(self._running) > 0:
+				self._cond.wait(1)
+
+	def _check(self, watch):
+		# Check a watch taken off the schedule, and put it back if it is to be checked again
+		again = False
+
+		try:
+			again = watch.check()
+		except:
+			with self._cond:
+				self._error = sys.exc_info()
+
+		with self._cond:
+			due = self._running.pop(watch)
+			retire_callback = self._retiring.pop(watch, None)
+
+			if again and due is not False:
+				self._push(watch, due)
+			elif not again:
+				logger.info("No longer watching thread [{0:s}].".format(watch.url))
+
+			self._cond.notify_all()
+
+		# Removed during the check, which is now done
+		if retire_callback != None:
+			retire_callback(watch)
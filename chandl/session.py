@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+class ConnectionCounters(object):
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.opened = 0
+		self.requests = 0
+
+	def connection_opened(self):
+		with self._lock:
+			self.opened += 1
+
+	def request_sent(self):
+		with self._lock:
+			self.requests += 1
+
+	@property
+	def reused(self):
+		return max(0, self.requests - self.opened)
+
+def counting_pool(base, counters):
+	class CountingConnectionPool(base):
+		def _new_conn(self):
+			counters.connection_opened()
+			return base._new_conn(self)
+
+		def _make_request(self, *args, **kwargs):
+			counters.request_sent()
+			return base._make_request(self, *args, **kwargs)
+
+	return CountingConnectionPool
+
+class CountingHTTPAdapter(HTTPAdapter):
+	def __init__(self, counters, **kwargs):
+		# Must be set before calling the base constructor, as it initializes the pool manager
+		self.counters = counters
+		super(CountingHTTPAdapter, self).__init__(**kwargs)
+
+	def init_poolmanager(self, *args, **kwargs):
+		super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+		self.poolmanager.pool_classes_by_scheme = {
+			'http': counting_pool(HTTPConnectionPool, self.counters),
+			'https': counting_pool(HTTPSConnectionPool, self.counters),
+		}
+
+class PooledSession(requests.Session):
+	def __init__(self, pool_connections=10, pool_maxsize=10, host_pool_sizes=None):
+		super(PooledSession, self).__init__()
+
+		self.counters = ConnectionCounters()
+
+		# Keep connections alive for reuse by subsequent requests
+		self.headers['Connection'] = 'keep-alive'
+
+		self.pool_connections = pool_connections
+		self.pool_maxsize = pool_maxsize
+
+		for prefix in ('http://', 'https://'):
+			self.mount(prefix, self._new_adapter(pool_maxsize))
+
+		if host_pool_sizes != None:
+			for host, size in host_pool_sizes.items():
+				self.set_host_pool_size(host, size)
+
+	def _new_adapter(self, maxsize):
+		return CountingHTTPAdapter(self.counters, pool_connections=self.pool_connections, pool_maxsize=maxsize)
+
+	def set_host_pool_size(self, host, size):
+		logger.debug("Using connection pool size {0:d} for host '{1:s}'.".format(size, host))
+
+		for scheme in ('http', 'https'):
+			self.mount('{0:s}://{1:s}/'.format(scheme, host), self._new_adapter(size))
+
+	@property
+	def connections_opened(self):
+		return self.counters.opened
+
+	@property
+	def connections_reused(self):
+		return self.counters.reused
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+from .utils import movefile, makedirs, hash_file
+
+def _link_or_copy(src, dst, hardlink):
+	if hardlink:
+		try:
+			os.link(src, dst)
+			return
+		except (OSError, AttributeError):
+			# Hard links are not supported on this filesystem (or platform) - copy it instead
+			logger.debug("Failed to create hard link to [{0:s}]. Copying.".format(src))
+
+	shutil.copy2(src, dst)
+
+def link_file(src, dst, link_mode):
+	makedirs(os.path.dirname(dst))
+
+	# Create the link under a temporary name first, so an existing file is only replaced once it succeeds
+	tmpfile = '{0:s}.link'.format(dst)
+	if os.path.lexists(tmpfile):
+		os.remove(tmpfile)
+
+	if link_mode == 'symbolic':
+		os.symlink(src, tmpfile)
+	else:
+		_link_or_copy(src, tmpfile, link_mode == 'hard')
+
+	movefile(tmpfile, dst)
+
+class MediaStore(object):
+	LINK_MODES = ('hard', 'symbolic', 'copy')
+
+	def __init__(self, root, link_mode='hard'):
+		if link_mode not in self.LINK_MODES:
+			raise ValueError("Unknown link mode '{0:s}'.".format(link_mode))
+
+		self.root = os.path.abspath(root)
+		self.link_mode = link_mode
+
+	def path_for(self, digest):
+		return os.path.join(self.root, digest[:2], digest)
+
+	def has(self, digest):
+		return os.path.isfile(self.path_for(digest))
+
+	def link(self, digest, saveto):
+		link_file(self.path_for(digest), saveto, self.link_mode)
+
+	def add(self, filename):
+		digest = hash_file(filename)
+		stored = self.path_for(digest)
+
+		if os.path.isfile(stored):
+			# Already stored - replace the file with a link to the stored copy
+			self.link(digest, filename)
+			return digest
+
+		makedirs(os.path.dirname(stored))
+
+		# Put the file in the store under a temporary name first, so a partially stored file is never used
+		tmpfile = '{0:s}.{1:s}.tmp'.format(stored, uuid.uuid4().hex)
+
+		if self.link_mode == 'symbolic':
+			# Move the file into the store, and put a link to it back in its place
+			shutil.move(filename, tmpfile)
+			movefile(tmpfile, stored)
+			self.link(digest, filename)
+		else:
+			_link_or_copy(filename, tmpfile, self.link_mode == 'hard')
+			movefile(tmpfile, stored)
+
+		return digest
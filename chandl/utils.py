@@ -1,9 +1,74 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import os
+import hashlib
+import uuid
 
-def movefile(src, dst):
-	if os.path.isfile(dst):
-		os.remove(dst)
+if os.name == 'nt':
+	import ctypes
 
-	os.rename(src, dst)
+	MOVEFILE_REPLACE_EXISTING = 0x1
+	MOVEFILE_WRITE_THROUGH = 0x8
+
+	def _unicode_path(path):
+		if isinstance(path, unicode):
+			return path
+
+		return path.decode(sys.getfilesystemencoding())
+
+	def movefile(src, dst):
+		# os.rename() cannot replace an existing file on Windows, but MoveFileEx() can, without removing it first
+		if not ctypes.windll.kernel32.MoveFileExW(_unicode_path(src), _unicode_path(dst), MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+			raise ctypes.WinError()
+else:
+	def movefile(src, dst):
+		# Replaces the destination atomically, so there is never a moment without it
+		os.rename(src, dst)
+
+def atomic_write(filename, chunks, commit=True):
+	# Write to a temporary file first, so a crash while writing never leaves a truncated file behind
+	# If commit is False, the temporary file is left for the caller to move into place, and its name returned
+	# The temporary file is unique to each write, so concurrent writers never write to or move each other's
+	tmpfile = '{0:s}.{1:s}.saving'.format(filename, uuid.uuid4().hex)
+
+	try:
+		with open(tmpfile, 'wb') as f:
+			for chunk in chunks:
+				f.write(chunk)
+
+			f.flush()
+			os.fsync(f.fileno())
+
+		if not commit:
+			return tmpfile
+
+		movefile(tmpfile, filename)
+	except:
+		if os.path.isfile(tmpfile):
+			os.remove(tmpfile)
+		raise
+
+def makedirs(path):
+	if os.path.isdir(path):
+		return
+
+	try:
+		os.makedirs(path)
+	except OSError:
+		# Another thread may have created it in the meantime
+		if not os.path.isdir(path):
+			raise
+
+def hash_file(filename, algorithm='md5'):
+	h = hashlib.new(algorithm)
+
+	with open(filename, 'rb') as f:
+		while True:
+			chunk = f.read(65536)
+			if not chunk:
+				break
+
+			h.update(chunk)
+
+	return h.hexdigest()
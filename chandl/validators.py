@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+from .utils import movefile
+
+class ValidatorCache(object):
+	def __init__(self, filename):
+		self.filename = filename
+
+		# Validators from the last successful response, as (etag, last modified, local path) by URL
+		# The local path is relative to the thread folder, and None for the thread page itself
+		self.entries = {}
+
+		self._lock = threading.Lock()
+
+		if os.path.isfile(filename):
+			self._load()
+
+	def _load(self):
+		lines = 0
+
+		with open(self.filename, 'rb') as f:
+			for line in f:
+				lines += 1
+
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# Most likely a line that was only partially written when the process died
+					logger.warn("Ignoring invalid line in validator cache [{0:s}].".format(self.filename))
+					continue
+
+				if entry['etag'] == None and entry['last-modified'] == None:
+					self.entries.pop(entry['url'], None)
+				else:
+					self.entries[entry['url']] = (entry['etag'], entry['last-modified'], entry.get('path'))
+
+		# Entries are appended every time they change, so rewrite the file once it is mostly outdated entries
+		if lines > 2 * len(self.entries) + 16:
+			self._compact()
+
+	def _compact(self):
+		tmpfile = '{0:s}.tmp'.format(self.filename)
+		with open(tmpfile, 'wb') as f:
+			for url, (etag, last_modified, path) in sorted(self.entries.items()):
+				f.write(json.dumps({'url' : url, 'etag' : etag, 'last-modified' : last_modified, 'path' : path}) + '\n')
+
+		movefile(tmpfile, self.filename)
+
+	def __contains__(self, url):
+		return url in self.entries
+
+	def headers(self, url):
+		# Return the headers needed to make a conditional request for the URL
+		etag, last_modified, path = self.entries.get(url, (None, None, None))
+		headers = {}
+
+		if etag != None:
+			headers['If-None-Match'] = etag
+
+		if last_modified != None:
+			headers['If-Modified-Since'] = last_modified
+
+		return headers
+
+	def files(self):
+		# Return the (url, path) of every downloaded file that can be revalidated
+		return sorted((url, path) for url, (etag, last_modified, path) in self.entries.items() if path != None)
+
+	def update(self, url, headers, path=None):
+		# Record the validators from a successful response's headers
+		etag, last_modified = headers.get('etag'), headers.get('last-modified')
+
+		# A response without validators cannot be revalidated
+		if etag == None and last_modified == None:
+			entry = None
+		else:
+			entry = (etag, last_modified, path)
+
+		with self._lock:
+			if entry == self.entries.get(url):
+				return
+
+			if entry == None:
+				del self.entries[url]
+			else:
+				self.entries[url] = entry
+
+			with open(self.filename, 'ab') as f:
+				f.write(json.dumps({'url' : url, 'etag' : etag, 'last-modified' : last_modified, 'path' : path}) + '\n')
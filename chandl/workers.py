@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+from .parser import ThreadParser
+from .metrics import Metrics
+from .helpers import post_number
+from . import fourchan
+
+def _init_worker():
+	# Leave handling CTRL+C to the main process, which cancels the checks using the pool
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def update_thread(job):
+	# Merge a downloaded page (or thread JSON) into a saved thread, and write the result next to it
+	# Runs in a worker process, so everything needed is in the job, and only the results needed by the downloader are returned
+	save_path = job['save_path']
+
+	if os.path.isfile(save_path):
+		parser = ThreadParser(job['url'], save_path, board_type = job['board_type'])
+	else:
+		parser = ThreadParser(job['url'], board_type = job['board_type'])
+
+	metrics = Metrics()
+	parser.metrics = metrics
+
+	if job['api']:
+		# Render and merge only the posts that are newer than the last one we have
+		last_post = post_number(parser.last_post_id())
+		newposts = [p for p in fourchan.load_posts(job['input']) if p['no'] > last_post]
+		parser.update_posts(fourchan.render_posts(job['board'], newposts))
+	else:
+		parser.update(job['input'])
+
+	# The saved thread is only replaced once the downloader has journaled the links found
+	savedfile = parser.save(save_path, commit = False)
+
+	relpaths = set(relpath for abslink, relpath in parser.links_found)
+
+	return {
+		'links' : parser.links_found,
+		'hashes' : dict((relpath, digest) for relpath, digest in parser.link_hashes.items() if relpath in relpaths),
+		'sizes' : dict((relpath, size) for relpath, size in parser.link_sizes.items() if relpath in relpaths),
+		'new_posts' : parser.new_post_count,
+		'board_type' : parser.board_type,
+		'saved' : savedfile,
+		'phases' : dict((phase, total) for phase, (count, total) in metrics.phases.items() if count > 0),
+	}
+
+class ParserPool(object):
+	# Parses and saves threads in worker processes, so watching many threads is not limited to one core
+	# Can be shared by any number of downloaders, in any number of threads
+
+	def __init__(self, processes=None):
+		# Number of worker processes (None = one per core)
+		self.processes = processes or multiprocessing.cpu_count()
+
+		self._pool = multiprocessing.Pool(self.processes, _init_worker)
+
+	def update(self, job):
+		# Run a job in a worker process, blocking until it is done
+		# Exceptions raised in the worker are raised again here
+		return self._pool.apply(update_thread, (job,))
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
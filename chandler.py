@@ -6,7 +6,10 @@ import os
 import platform
 import logging
 import signal
+import json
 import time
+import urllib
+import urllib2
 from optparse import OptionParser
 
 from chandl import *
@@ -49,6 +52,19 @@ def report(text):
 
 report.prev_length = 0
 
+def parse_rate(text):
+	# Parse a number of bytes with an optional k/M/G suffix
+	if text == None:
+		return None
+
+	units = { 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+
+	text = text.strip().lower()
+	if len(text) > 0 and text[-1] in units:
+		return float(text[:-1]) * units[text[-1]]
+
+	return float(text)
+
 class ProcessAlreadyRunning(Exception):
 	pass
 
@@ -99,19 +115,85 @@ def main():
 	op.add_option('', '--no-subfolder', dest = 'no_subfolder', default = False, action = 'store_true',
 		help = "don't create a subfolder for each thread in the destination folder")
 	op.add_option('-c', '--continuous', dest = 'continuous', default = False, action = 'store_true',
-		help = "continuously re-download until 404 (will be ignored if multiple threads are specified)")
+		help = "continuously re-download until 404")
 	op.add_option('-i', '--interval', dest = 'interval', type = 'float', default = 30,
 		help = "number of seconds between checks (default: 30)")
 	op.add_option('', '--auto-increment', dest = 'auto_increment', type = 'float', default = 5,
 		help = "number of seconds to add per auto-increment (default: 5) (0 = disable)")
 	op.add_option('', '--max-auto-increment', dest = 'max_auto_increment', type = 'float', default = 90,
 		help = "maximum increase for auto-increment (default: 90)")
+	op.add_option('', '--adaptive', dest = 'adaptive', default = False, action = 'store_true',
+		help = "adapt the interval between checks to the rate of new posts in the thread")
+	op.add_option('', '--min-interval', dest = 'min_interval', type = 'float', default = 10,
+		help = "minimum number of seconds between checks when using --adaptive (default: 10)")
+	op.add_option('', '--max-interval', dest = 'max_interval', type = 'float', default = 600,
+		help = "maximum number of seconds between checks when using --adaptive (default: 600)")
 	op.add_option('-r', '--retry', dest = 'retry', type = 'int', default = 10,
 		help = "number of times to retry (with increasing delay) on HTTP errors (excluding 404)")
 	op.add_option('', '--retry-increment', dest = 'retry_increment', type = 'int', default = 120,
 		help = "number of seconds to add for each failed check (default: 120)")
 	op.add_option('-f', '--force', dest = 'force', default = False, action = 'store_true',
-		help = "force re-download")
+		help = "force processing the thread again, revalidating the page and any downloaded files whose ETag or Last-Modified is known")
+	op.add_option('-w', '--workers', dest = 'workers', type = 'int', default = 4,
+		help = "number of files to download simultaneously (default: 4)")
+	op.add_option('', '--host-workers', dest = 'host_workers', type = 'int', default = 2,
+		help = "maximum number of simultaneous downloads from the same host (default: 2) (0 = unlimited)")
+	op.add_option('', '--pool-size', dest = 'pool_size', type = 'int', default = 10,
+		help = "number of connections to keep alive per host (default: 10)")
+	op.add_option('', '--host-pool-size', dest = 'host_pool_sizes', default = '',
+		help = "semicolon-separated list of per-host connection pool sizes (ex: i.4cdn.org=8;s.4cdn.org=4)")
+	op.add_option('', '--limit-rate', dest = 'limit_rate', default = None,
+		help = "limit total download speed, in bytes per second (ex: 500k, 2M)")
+	op.add_option('', '--limit-requests', dest = 'limit_requests', type = 'float', default = None,
+		help = "limit total number of requests per second")
+	op.add_option('', '--host-limit-rate', dest = 'host_limit_rate', default = None,
+		help = "limit download speed from each host, in bytes per second (ex: 500k, 2M)")
+	op.add_option('', '--host-limit-requests', dest = 'host_limit_requests', type = 'float', default = None,
+		help = "limit number of requests per second to each host")
+	op.add_option('', '--api', dest = 'use_api', default = False, action = 'store_true',
+		help = "use the JSON API to check for new posts where supported (currently 4chan)")
+	op.add_option('', '--store', dest = 'store', default = None,
+		help = "specify path of a content-addressed store shared between threads, so identical files are only downloaded and stored once")
+	op.add_option('', '--store-link', dest = 'store_link', default = 'hard',
+		help = "specify how files in the store are linked into thread folders: hard, symbolic or copy (default: hard)")
+	op.add_option('', '--asset-cache', dest = 'asset_cache', default = False, action = 'store_true',
+		help = "keep the site's own files (stylesheets, scripts, icons and images) in a cache under the destination, and link them into thread folders instead of downloading them for every thread")
+	op.add_option('', '--asset-max-age', dest = 'asset_max_age', type = 'float', default = 60,
+		help = "number of minutes before a cached site file is checked for changes when using --asset-cache (default: 60)")
+	op.add_option('', '--rebuild-manifest', dest = 'rebuild_manifest', default = False, action = 'store_true',
+		help = "rebuild the list of downloaded files from the files found on disk")
+	op.add_option('', '--catalog', dest = 'catalog', default = False, action = 'store_true',
+		help = "treat URLs as boards, and watch every thread found in their catalogs that matches the filters")
+	op.add_option('', '--catalog-interval', dest = 'catalog_interval', type = 'float', default = 60,
+		help = "number of seconds between catalog checks when using --catalog (default: 60)")
+	op.add_option('', '--subject', dest = 'subject', default = None,
+		help = "only watch catalog threads whose subject matches this regular expression")
+	op.add_option('', '--min-replies', dest = 'min_replies', type = 'int', default = 0,
+		help = "only watch catalog threads with at least this many replies (default: 0)")
+	op.add_option('', '--metrics-events', dest = 'metrics_events', default = None,
+		help = "append timing and counter events for every check to this file, as JSON lines")
+	op.add_option('', '--metrics-prometheus', dest = 'metrics_prometheus', default = None,
+		help = "write timing and counter totals to this file after every check, in Prometheus' text format")
+	op.add_option('', '--low-memory', dest = 'low_memory', default = False, action = 'store_true',
+		help = "keep only a compact state of each thread in memory between checks, parsing it again when new posts arrive (for watching many threads)")
+	op.add_option('', '--parse-pool', dest = 'parse_pool', default = False, action = 'store_true',
+		help = "parse and save threads in a pool of worker processes, so watching many threads can use more than one core")
+	op.add_option('', '--parse-processes', dest = 'parse_processes', type = 'int', default = 0,
+		help = "number of worker processes when using --parse-pool (default: number of cores)")
+	op.add_option('', '--concurrent-checks', dest = 'concurrent_checks', type = 'int', default = 0,
+		help = "number of threads to check at the same time (default: 1, --max-checks when using --engine, or the number of worker processes when using --parse-pool)")
+	op.add_option('', '--engine', dest = 'engine', default = False, action = 'store_true',
+		help = "run the checks and file downloads of all threads on one shared set of workers, capped by --max-checks and --max-transfers")
+	op.add_option('', '--max-checks', dest = 'max_checks', type = 'int', default = 16,
+		help = "maximum number of threads being checked at the same time when using --engine (default: 16)")
+	op.add_option('', '--max-transfers', dest = 'max_transfers', type = 'int', default = 32,
+		help = "maximum number of files being downloaded at the same time, across all threads, when using --engine (default: 32)")
+	op.add_option('', '--daemon', dest = 'daemon', default = False, action = 'store_true',
+		help = "keep running even when no threads are left to watch, and accept commands on the control port (implies -c)")
+	op.add_option('', '--control-port', dest = 'control_port', type = 'int', default = 8765,
+		help = "localhost port for controlling a process started with --daemon (default: 8765)")
+	op.add_option('', '--control', dest = 'control', default = None,
+		help = "send a command to a process started with --daemon instead of downloading: add or remove the URLs given, or report the status of every thread")
 	op.add_option('', '--include-ext', dest = 'include_extensions', default = '',
 		help = "semicolon-separated list of additional file extensions to download (ex: .js;.svg)")
 	op.add_option('', '--no-merge', dest = 'nomerge', default = False, action = 'store_true',
@@ -131,10 +213,18 @@ def main():
 
 	(opts, args) = op.parse_args()
 
-	if len(args) < 1:
+	if opts.control != None:
+		return control(opts, args)
+
+	if len(args) < 1 and not opts.daemon:
 		op.print_help()
 		return 1
 
+	if opts.daemon:
+		opts.continuous = True
+
+	opts.urls = args
+
 	# Determine logging level based on commandline flags
 	if opts.debug:
 		level = logging.DEBUG
@@ -171,16 +261,78 @@ def main():
 		# on which it is not supported, such as Microsoft Windows
 		logger.info("Terminal resize not supported.")
 
-	if opts.continuous and len(args) > 1:
-		output("More than one URL specified. Continuous flag will be ignored.")
-		opts.continuous = False
-
 	include_extensions = frozenset(opts.include_extensions.split(';'))
 
-	for url in args:
-		if terminate:
-			break
+	# Parse per-host connection pool sizes
+	host_pool_sizes = {}
+	for hps in opts.host_pool_sizes.split(';'):
+		if len(hps) > 0:
+			host, size = hps.split('=', 1)
+			host_pool_sizes[host.strip()] = int(size)
+
+	# Create a session that is shared by all downloaders, so connections can be reused across threads
+	# With --engine, up to --max-transfers files are downloaded at the same time across all threads
+	if opts.engine:
+		pool_maxsize = max(opts.pool_size, opts.max_transfers)
+	else:
+		pool_maxsize = max(opts.pool_size, opts.workers)
+
+	session = PooledSession(pool_maxsize = pool_maxsize, host_pool_sizes = host_pool_sizes)
+
+	# Create a rate limiter that is shared by all downloaders, if any limits were specified
+	limits = (parse_rate(opts.limit_rate), opts.limit_requests, parse_rate(opts.host_limit_rate), opts.host_limit_requests)
+	if any(limits):
+		rate_limiter = RateLimiter(*limits)
+	else:
+		rate_limiter = None
+
+	# Create metrics shared by all downloaders, if any output for them was specified
+	if opts.metrics_events != None or opts.metrics_prometheus != None:
+		metrics = Metrics(events_file = opts.metrics_events, prometheus_file = opts.metrics_prometheus)
+	else:
+		metrics = NullMetrics()
+
+	# Create a pool of worker processes shared by all downloaders, if parsing is to be offloaded
+	if opts.parse_pool:
+		parser_pool = ParserPool(opts.parse_processes or None)
+	else:
+		parser_pool = None
+
+	# Create an engine shared by all downloaders, if checks and downloads are to be capped across all threads
+	if opts.engine:
+		engine = DownloadEngine(max_checks = opts.max_checks, max_transfers = opts.max_transfers, host_transfers = opts.host_workers or None)
+	else:
+		engine = None
+
+	if opts.concurrent_checks > 0:
+		concurrency = opts.concurrent_checks
+	elif engine != None:
+		concurrency = engine.max_checks
+	elif parser_pool != None:
+		concurrency = parser_pool.processes
+	else:
+		concurrency = 1
+
+	if opts.store != None:
+		store = MediaStore(opts.store, link_mode = opts.store_link)
+	else:
+		store = None
+
+	# If the user specified a destination path, use that. Otherwise create a directory matching the thread number in the current working directory.
+	if opts.destpath != None:
+		saveto = opts.destpath
+	else:
+		saveto = os.getcwd()
 
+	if opts.asset_cache:
+		asset_cache = AssetCache(os.path.join(saveto, '.assets'), max_age = opts.asset_max_age * 60, link_mode = opts.store_link)
+	else:
+		asset_cache = None
+
+	# PID files of the threads being watched, keyed by thread URL
+	pids = {}
+
+	def create_watch(url):
 		if opts.progress == 'on':
 			rotator = "-\|/"
 			def progress(prg, currentfile, filestotal, url):
@@ -200,18 +352,12 @@ def main():
 			progress = None
 
 		# Create downloader instance
-		downloader = ThreadDownloader(url, None, None, output_callback = output, progress_callback = progress, cancel_callback = cancel_callback)
+		downloader = ThreadDownloader(url, None, None, output_callback = output, progress_callback = progress, cancel_callback = cancel_callback, session = session)
 
 		# Set board type if specified
 		if opts.board_type != None:
 			downloader.set_board_type(opts.board_type)
 
-		# If the user specified a destination path, use that. Otherwise create a directory matching the thread number in the current working directory.
-		if opts.destpath != None:
-			saveto = opts.destpath
-		else:
-			saveto = os.getcwd()
-
 		downloader.set_destination(saveto, opts.output, no_subdir = opts.no_subfolder)
 
 		if opts.nomerge:
@@ -222,95 +368,206 @@ def main():
 		# Add included extensions to downloader's list of extensions
 		downloader.download_extensions.update(include_extensions)
 
+		downloader.use_api = opts.use_api
+		downloader.store = store
+		downloader.asset_cache = asset_cache
+		downloader.workers = opts.workers
+		downloader.host_workers = opts.host_workers or None
+		downloader.rate_limiter = rate_limiter
+		downloader.metrics = metrics
+		downloader.low_memory = opts.low_memory
+		downloader.parser_pool = parser_pool
+		downloader.engine = engine
+
 		try:
-			with PID(os.path.join(downloader.save_dir, 'chandler.pid'), ignore_pid = opts.ignore_pid):
-				run_downloader(downloader, opts)
+			pid = PID(os.path.join(downloader.save_dir, 'chandler.pid'), ignore_pid = opts.ignore_pid)
 		except ProcessAlreadyRunning:
-			output("PID file exists and its process appears to be running. Terminating.")
+			output("PID file for thread [{0:s}] exists and its process appears to be running. Skipped.".format(url))
+			return None
 
-	return 0
+		pid.__enter__()
+		pids[url] = pid
 
-def run_downloader(downloader, opts):
-	global terminate
+		if opts.adaptive:
+			policy = AdaptiveInterval(opts.interval, min_interval = opts.min_interval, max_interval = opts.max_interval)
+		else:
+			policy = None
+
+		if opts.rebuild_manifest:
+			downloader.rebuild_manifest()
+
+		return ThreadWatch(downloader,
+			interval = opts.interval,
+			auto_increment = opts.auto_increment,
+			max_auto_increment = opts.max_auto_increment,
+			retry = opts.retry,
+			retry_increment = opts.retry_increment,
+			force = opts.force,
+			output_callback = output,
+			report_callback = report,
+			policy = policy)
+
+	def retire_watch(watch):
+		# Release the PID file of a thread that is no longer being watched
+		pid = pids.pop(watch.url, None)
+		if pid != None:
+			pid.__exit__(None, None, None)
+
+	scheduler = Scheduler(cancel_callback = cancel_callback, wait_callback = wait_callback(opts), concurrency = concurrency, persistent = opts.daemon, engine = engine)
+
+	def create_catalog_watch(url):
+		catalog = BoardCatalog(url, session = session)
+		catalog.rate_limiter = rate_limiter
+
+		return CatalogWatch(catalog, scheduler, create_watch,
+			interval = opts.catalog_interval,
+			subject = opts.subject,
+			min_replies = opts.min_replies,
+			retry = opts.retry,
+			retry_increment = opts.retry_increment,
+			output_callback = output,
+			report_callback = report,
+			retire_callback = retire_watch)
+
+	if opts.catalog:
+		watch_factory = create_catalog_watch
+	else:
+		watch_factory = create_watch
+
+	if opts.daemon:
+		control_server = ControlServer(scheduler, watch_factory, retire_callback = retire_watch, port = opts.control_port)
+		control_server.start()
 
-	url = downloader.thread_url
+		output("Accepting commands on [{0:s}]".format(control_server.url))
+	else:
+		control_server = None
 
-	# Define function for performing a download attempt
-	def checkthread():
-		report("Checking thread [{0:s}] for updates...".format(url))
+	try:
+		for url in args:
+			watch = watch_factory(url)
 
+			if watch == None:
+				continue
+
+			scheduler.add(watch)
+
+		run_watches(scheduler, opts)
+	finally:
+		if control_server != None:
+			control_server.stop()
+
+		for pid in pids.values():
+			pid.__exit__(None, None, None)
+
+		metrics.close()
+
+		if parser_pool != None:
+			parser_pool.close()
+
+		if engine != None:
+			engine.close()
+
+	logger.info("HTTP connections opened: {0:d}, reused: {1:d}".format(session.connections_opened, session.connections_reused))
+
+	if rate_limiter != None:
+		logger.info("Rate limiter waited {0:.1f}s for requests, {1:.1f}s for bandwidth".format(rate_limiter.waited['requests'], rate_limiter.waited['bytes']))
+
+		for host, waited in sorted(rate_limiter.host_waited.items()):
+			logger.info("  {0:s}: {1:.1f}s for requests, {2:.1f}s for bandwidth".format(host, waited['requests'], waited['bytes']))
+
+	return 0
+
+def control(opts, args):
+	# Send a command to a running daemon, and print its response
+	base = 'http://127.0.0.1:{0:d}/threads'.format(opts.control_port)
+
+	def send(request):
 		try:
-			downloader.download(force = checkthread.force)
-			checkthread.checks_since_last_update = 0
-		except CancelException:
-			output("Download cancelled. Thread has not been saved.")
-			return False
-		except ThreadNotModified as e:
-			output(e)
-			checkthread.checks_since_last_update += 1
-		except ThreadNotFound as e:
-			output(e)
-			return False
-		except (ThreadHTTPError, ConnectionError, IncompleteDownload) as e:
-			output(e)
-
-			if checkthread.retry < opts.retry:
-				checkthread.retry += 1
-				return True
-
-			return False
-		finally:
-			# Reset force after first run
-			checkthread.force = False
-
-			# Set last checked time
-			checkthread.last_check = time.time()
-
-		# Check succeeded, reset retry count
-		checkthread.retry = 0
-		return True
-
-	# Set checkthread's force variable to the one specified by commandline (or false if unspecified)
-	# Doing it this way is necessary because it is not possible to set a variable in an outer scope from inside a nested function
-	checkthread.force = opts.force
-	checkthread.retry = 0
-	checkthread.last_check = None
-	checkthread.checks_since_last_update = 0
-
-	if opts.continuous:
-		# Loop until a download attempt fails (or is canceled)
-		while not terminate:
-			# Check thread
-			if not checkthread():
-				break
+			r = urllib2.urlopen(request)
+			return r.getcode(), r.read()
+		except urllib2.HTTPError as e:
+			return e.code, e.read()
+		except urllib2.URLError as e:
+			return None, json.dumps({'error' : "Could not reach the daemon on port {0:d} ({1:s}).".format(opts.control_port, str(e.reason))})
+
+	if opts.control == 'status':
+		code, body = send(base)
+
+		if code == 200:
+			now = time.time()
+
+			for status in json.loads(body):
+				if status['checking']:
+					when = "checking now"
+				elif status['next_check'] != None:
+					when = "next check in {0:.0f}s".format(max(status['next_check'] - now, 0))
+				else:
+					when = "stopped"
+
+				if status['type'] == 'catalog':
+					print "{0:s} [catalog]: {1:s}, {2:d} threads".format(status['url'], when, status['threads'])
+				else:
+					print "{0:s}: {1:s}, {2:d} queued, {3:.0f} bytes/s".format(status['url'], when, status['queued'], status['bytes_per_second'])
 
-			if checkthread.retry == 0:
-				interval = opts.interval + min(opts.auto_increment * checkthread.checks_since_last_update, opts.max_auto_increment)
+			return 0
+	elif opts.control in ('add', 'remove'):
+		for url in args:
+			if opts.control == 'add':
+				request = urllib2.Request(base, json.dumps({'url' : url}), {'Content-Type' : 'application/json'})
 			else:
-				interval = (opts.retry_increment * checkthread.retry)
+				request = urllib2.Request('{0:s}?{1:s}'.format(base, urllib.urlencode({'url' : url})))
+				request.get_method = lambda: 'DELETE'
 
-			while not terminate:
-				now = time.time()
-				elapsed = now - checkthread.last_check
-				remaining = interval - elapsed
+			code, body = send(request)
 
-				if remaining < 0:
-					break
+			if code == None or code >= 400:
+				break
 
-				if checkthread.retry == 0:
-					report("Checking in {0:.0f}".format(remaining))
-				else:
-					report("Retrying ({1:d} of {2:d}) in {0:.0f}".format(remaining, checkthread.retry, opts.retry))
-
-				try:
-					time.sleep(1)
-				except IOError:
-					# User pressed CTRL-C, break loop
-					output("User pressed CTRL-C. Terminating.")
-					break
+			print "{0:s} [{1:s}]".format("Watching" if opts.control == 'add' else "No longer watching", url)
+		else:
+			return 0
 	else:
-		# Just run download once
-		checkthread()
+		print "Unknown command '{0:s}'.".format(opts.control)
+		return 1
+
+	print json.loads(body)['error']
+	return 1
+
+def wait_callback(opts):
+	def wait(watch, remaining):
+		if opts.catalog or len(opts.urls) > 1:
+			name = " [{0:s}]".format(watch.url)
+		else:
+			name = ""
+
+		if watch.retries == 0:
+			report("Checking{1:s} in {0:.0f}".format(remaining, name))
+		else:
+			report("Retrying{3:s} ({1:d} of {2:d}) in {0:.0f}".format(remaining, watch.retries, opts.retry, name))
+
+	return wait
+
+def run_watches(scheduler, opts):
+	global terminate
+
+	if not opts.continuous:
+		# Check each catalog once, so the threads it finds are added to the schedule
+		for watch in scheduler.watches:
+			if isinstance(watch, CatalogWatch):
+				scheduler.remove(watch)
+				watch.check()
+
+		# Just run each download once
+		for watch in scheduler.watches:
+			if terminate:
+				break
+
+			watch.check()
+
+		return
+
+	# Check all threads (and catalogs) from a single schedule, each one when it is due, until they have all failed (or are cancelled)
+	scheduler.run()
 
 if __name__ == '__main__':
 	sys.exit(main())
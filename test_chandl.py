@@ -44,14 +44,867 @@ class HTTPrettify(object):
 		httpretty.disable()
 		httpretty.reset()
 
-def test_4chan_simple(tmpdir):
-	savedir = tmpdir.mkdir('savedir')
-
+def download_4chan_simple(savedir, **attrs):
 	with HTTPrettify():
 		mock_thread('http://boards.4chan.org/g/thread/39894014', 'testdata/4chan-simple/39894014.html')
 		downloader = chandl.ThreadDownloader('http://boards.4chan.org/g/thread/39894014', str(savedir), None)
+		for name, value in attrs.items():
+			setattr(downloader, name, value)
 		downloader.download()
 
 	threaddir = savedir.join('boards.4chan.org', 'g', '39894014')
 	dircmp = filecmp.dircmp(str(threaddir), 'testdata/4chan-simple')
 	assert_identical(dircmp)
+
+"""Run each test using it both on the calling thread and on a shared download engine"""
+@pytest.fixture(params=['blocking', 'engine'])
+def engine(request):
+	if request.param == 'engine':
+		with chandl.DownloadEngine(max_checks=2, max_transfers=4, host_transfers=2) as engine:
+			yield engine
+	else:
+		yield None
+
+def test_4chan_simple(tmpdir, engine):
+	download_4chan_simple(tmpdir.mkdir('savedir'), engine=engine)
+
+def test_download_engine():
+	import threading
+	import time
+
+	running = []
+	overlapped = threading.Event()
+
+	def transfer(url):
+		running.append(url)
+		if len(running) == 2:
+			overlapped.set()
+
+		overlapped.wait(5)
+		return url
+
+	def check():
+		raise chandl.ThreadNotModified("not modified")
+
+	with chandl.DownloadEngine(max_checks=1, max_transfers=2) as engine:
+		urls = ['http://a.example.com/1.jpg', 'http://b.example.com/2.jpg']
+		tasks = [engine.transfer(transfer, url) for url in urls]
+		assert [task.result() for task in tasks] == urls
+		assert overlapped.is_set()
+
+		# Exceptions are raised again by whoever waits for the task
+		with pytest.raises(chandl.ThreadNotModified):
+			engine.check(check).result()
+
+	# No more than the maximum number of transfers run for the same host at once
+	lock = threading.Lock()
+	active = {'now' : 0, 'max' : 0}
+
+	def slow_transfer(url):
+		with lock:
+			active['now'] += 1
+			active['max'] = max(active['max'], active['now'])
+
+		time.sleep(0.05)
+
+		with lock:
+			active['now'] -= 1
+
+	with chandl.DownloadEngine(max_transfers=8, host_transfers=2) as engine:
+		tasks = [engine.transfer(slow_transfer, 'http://i.4cdn.org/g/{0:d}.jpg'.format(i)) for i in range(8)]
+		for task in tasks:
+			task.result()
+
+	assert active['max'] == 2
+
+def test_4chan_simple_workers(tmpdir):
+	download_4chan_simple(tmpdir.mkdir('savedir'), workers=4, host_workers=2)
+
+def test_4chan_simple_shared_session(tmpdir):
+	session = chandl.PooledSession()
+	download_4chan_simple(tmpdir.mkdir('savedir'), session=session)
+
+	# 14 files plus the thread page, spread over 4 hosts
+	assert session.connections_opened == 4
+	assert session.connections_reused == 11
+
+def test_4chan_simple_parser_pool(tmpdir):
+	with chandl.ParserPool(2) as pool:
+		download_4chan_simple(tmpdir.mkdir('savedir'), parser_pool=pool)
+
+def test_4chan_simple_metrics(tmpdir):
+	import json
+
+	events = tmpdir.join('events.jsonl')
+	metrics = chandl.Metrics(events_file=str(events), prometheus_file=str(tmpdir.join('chandl.prom')))
+
+	download_4chan_simple(tmpdir.mkdir('savedir'), metrics=metrics)
+	metrics.close()
+
+	# The page and 14 files were downloaded, and each phase except merging ran once
+	size = sum(os.path.getsize(os.path.join(root, fn)) for root, dirs, files in os.walk('testdata/4chan-simple/files') for fn in files)
+	assert metrics.counters == { 'files' : 14, 'bytes' : size + os.path.getsize('testdata/4chan-simple/39894014.html.original') }
+	assert dict((phase, count) for phase, (count, total) in metrics.phases.items()) == { 'fetch' : 1, 'parse' : 1, 'merge' : 0, 'link_scan' : 1, 'download' : 1, 'save' : 1 }
+
+	lines = [json.loads(line) for line in events.readlines()]
+	assert len([e for e in lines if e['type'] == 'counter' and e['name'] == 'files']) == 14
+	assert set(e['thread'] for e in lines if e['type'] == 'timing') == set(['http://boards.4chan.org/g/thread/39894014'])
+
+	prom = tmpdir.join('chandl.prom').read()
+	assert 'chandl_phase_seconds_count{phase="fetch"} 1\n' in prom
+	assert 'chandl_files_total 14\n' in prom
+
+def test_download_priority(tmpdir):
+	from chandl.priority import document_order
+
+	urls = [
+		'http://i.4cdn.org/g/1390842451744.webm',
+		'http://i.4cdn.org/g/1390842451745.png',
+		'http://s.4cdn.org/image/sticky.gif',
+		'http://0.t.4cdn.org/g/1390842451744s.jpg',
+		'http://s.4cdn.org/js/core.js',
+		'http://s.4cdn.org/css/yotsubanew.560.css',
+	]
+
+	downloader = chandl.ThreadDownloader('http://boards.4chan.org/g/thread/39894014', str(tmpdir), None)
+	downloader.download_queue.extend((url, str(i)) for i, url in enumerate(urls))
+	downloader.download_sizes.update({ '0' : 4 * 1024 ** 2, '1' : 300 * 1024 })
+
+	# Page assets (including the site's images) first, then thumbnails, then media - smallest first, and files of unknown size last
+	downloader._prioritize_queued()
+	assert [url for url, saveto in downloader.download_queue] == [urls[2], urls[4], urls[5], urls[3], urls[1], urls[0]]
+
+	# The policy can be replaced, ie. to keep files in the order they were found
+	downloader.download_queue.clear()
+	downloader.download_queue.extend((url, str(i)) for i, url in enumerate(urls))
+	downloader.priority = document_order
+	downloader._prioritize_queued()
+	assert [url for url, saveto in downloader.download_queue] == urls
+
+	# Sizes are taken from the thumbnails' alt text
+	parser = chandl.ThreadParser('http://boards.4chan.org/g/thread/39894014')
+	parser.update('testdata/4chan-simple/39894014.html.original')
+	assert parser.link_sizes == { 'files/i.4cdn.org/g/1390842451744.png' : 293 * 1024 }
+
+def test_4chan_simple_rate_limited(tmpdir):
+	limiter = chandl.RateLimiter(bytes_per_second=1024, host_requests_per_second=1)
+	slept = []
+	limiter._sleep = slept.append
+
+	download_4chan_simple(tmpdir.mkdir('savedir'), rate_limiter=limiter)
+
+	# Repeated requests to the same host, and every byte after the first second's worth, had to wait
+	assert limiter.waited['requests'] > 0 and limiter.waited['bytes'] > 0
+	assert 'i.4cdn.org' in limiter.host_waited
+	assert sum(slept) == pytest.approx(limiter.waited['requests'] + limiter.waited['bytes'])
+
+def test_rate_limiter():
+	limiter = chandl.RateLimiter(bytes_per_second=1000, host_requests_per_second=1)
+	limiter._sleep = lambda seconds: None
+
+	# The first request to each host is allowed right away, and the next one has to wait for a token
+	assert limiter.request('http://a/1') == 0
+	assert limiter.request('http://b/1') == 0
+	assert limiter.request('http://a/2') == pytest.approx(1, abs=0.1)
+
+	# Bandwidth is shared by all hosts
+	assert limiter.transfer('http://a/1', 1000) == 0
+	assert limiter.transfer('http://b/1', 500) == pytest.approx(0.5, abs=0.1)
+
+	assert limiter.host_waited['a']['requests'] == pytest.approx(1, abs=0.1)
+	assert limiter.host_waited['b']['bytes'] == pytest.approx(0.5, abs=0.1)
+
+def test_scheduler_order():
+	checked = []
+
+	class FakeWatch(object):
+		def __init__(self, name, checks):
+			self.url = name
+			self.checks = checks
+
+		def check(self):
+			checked.append(self.url)
+			self.checks -= 1
+			return self.checks > 0
+
+		def next_check(self):
+			# Always due immediately, after any watch that is already queued
+			return 0
+
+	scheduler = chandl.Scheduler()
+	scheduler.add(FakeWatch('c', 1), due=3)
+	scheduler.add(FakeWatch('a', 2), due=1)
+	scheduler.add(FakeWatch('b', 1), due=2)
+	scheduler.run()
+
+	assert checked == ['a', 'a', 'b', 'c']
+
+def test_scheduler_concurrent(engine):
+	import threading
+
+	running = []
+	on_engine = []
+	overlapped = threading.Event()
+
+	class SlowWatch(object):
+		def __init__(self, name):
+			self.url = name
+
+		def check(self):
+			running.append(self.url)
+			on_engine.append(engine != None and engine.in_check())
+			if len(running) == 2:
+				overlapped.set()
+
+			# Both checks are running at the same time, or this times out
+			overlapped.wait(5)
+			return False
+
+		def next_check(self):
+			return 0
+
+	scheduler = chandl.Scheduler(concurrency=2, engine=engine)
+	scheduler.add(SlowWatch('a'))
+	scheduler.add(SlowWatch('b'))
+	scheduler.run()
+
+	assert overlapped.is_set()
+	assert len(scheduler) == 0
+
+	# With an engine, checks run on its workers rather than on threads of their own
+	assert on_engine == [engine != None] * 2
+
+def test_control_server(tmpdir):
+	import json
+	import urllib2
+
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	retired = []
+
+	def create_watch(url):
+		downloader = chandl.ThreadDownloader(url, str(tmpdir), None)
+		downloader.download_queue.append(('http://i.4cdn.org/g/1.jpg', str(tmpdir.join('1.jpg'))))
+		return chandl.ThreadWatch(downloader)
+
+	scheduler = chandl.Scheduler(persistent=True)
+
+	with chandl.ControlServer(scheduler, create_watch, retire_callback=retired.append) as control:
+		threads = control.url + '/threads'
+
+		def add(url):
+			return urllib2.urlopen(urllib2.Request(threads, json.dumps({'url' : url}), {'Content-Type' : 'application/json'}))
+
+		r = add(url)
+		assert r.getcode() == 201
+		assert json.loads(r.read())['queued'] == 1
+		assert len(scheduler) == 1
+
+		# Adding a thread already being watched returns the existing watch
+		assert add(url).getcode() == 200
+		assert len(scheduler) == 1
+
+		status = json.loads(urllib2.urlopen(threads).read())
+		assert [(s['url'], s['type'], s['queued'], s['checking']) for s in status] == [(url, 'thread', 1, False)]
+
+		with pytest.raises(urllib2.HTTPError) as e:
+			add('http://example.com/')
+		assert e.value.code == 400
+
+		# Requests a web page could make without asking first are refused
+		with pytest.raises(urllib2.HTTPError) as e:
+			urllib2.urlopen(urllib2.Request(threads, json.dumps({'url' : url}), {'Content-Type' : 'text/plain'}))
+		assert e.value.code == 415
+
+		with pytest.raises(urllib2.HTTPError) as e:
+			urllib2.urlopen(urllib2.Request(threads, headers={'Host' : 'attacker.example.com'}))
+		assert e.value.code == 403
+
+		request = urllib2.Request(threads + '?url=' + url)
+		request.get_method = lambda: 'DELETE'
+		assert urllib2.urlopen(request).getcode() == 204
+
+		with pytest.raises(urllib2.HTTPError) as e:
+			urllib2.urlopen(request)
+		assert e.value.code == 404
+
+	assert len(scheduler) == 0
+	assert [w.url for w in retired] == [url]
+
+def test_scheduler_remove_while_checking():
+	import threading
+
+	events = []
+	checking = threading.Event()
+	finish = threading.Event()
+
+	class SlowWatch(object):
+		url = 'a'
+
+		def check(self):
+			checking.set()
+			finish.wait(5)
+
+			events.append('checked')
+			return True
+
+		def next_check(self):
+			return 0
+
+	watch = SlowWatch()
+	scheduler = chandl.Scheduler(concurrency=2)
+	scheduler.add(watch)
+
+	t = threading.Thread(target=scheduler.run)
+	t.start()
+
+	checking.wait(5)
+	scheduler.remove(watch, lambda w: events.append('retired'))
+	assert scheduler.watches == []
+	finish.set()
+	t.join(5)
+
+	# Retired only once its check was done, and not scheduled again
+	assert events == ['checked', 'retired']
+	assert len(scheduler) == 0
+
+def test_adaptive_interval():
+	policy = chandl.AdaptiveInterval(30, min_interval=10, max_interval=600)
+
+	# Nothing is known until the second check
+	policy.observe(None, 0)
+	assert policy.next_interval() == 30
+
+	# A busy thread is polled more often, but the interval only halves at most per check, and never goes below the minimum
+	policy.observe(10, 30)
+	assert policy.next_interval() == 15
+
+	for i in range(5):
+		policy.observe(10, 60 + i * 10)
+
+	assert policy.next_interval() == 10
+
+def test_adaptive_interval_not_modified():
+	policy = chandl.AdaptiveInterval(30, min_interval=10, max_interval=600)
+
+	# A first check without new posts slows down from the configured interval, rather than jumping straight to the maximum
+	policy.observe(None, 0)
+	policy.observe(0, 30)
+	assert 30 < policy.next_interval() <= 60
+
+	# A dead thread backs off steadily, up to the maximum
+	now = 30
+	intervals = [policy.next_interval()]
+
+	for i in range(10):
+		now += intervals[-1]
+		policy.observe(0, now)
+		intervals.append(policy.next_interval())
+
+	assert all(a < b <= a * 2 for a, b in zip(intervals, intervals[1:]) if a < 600)
+	assert intervals[-1] == 600
+
+	# New posts bring it back down gradually
+	policy.observe(5, now + 600)
+	assert 300 <= policy.next_interval() < 600
+
+def test_4chan_api_update(tmpdir):
+	savedir = tmpdir.mkdir('savedir')
+
+	with HTTPrettify():
+		mock_thread('http://boards.4chan.org/g/thread/39894014', 'testdata/4chan-simple/39894014.html')
+		downloader = chandl.ThreadDownloader('http://boards.4chan.org/g/thread/39894014', str(savedir), None)
+		downloader.use_api = True
+		downloader.download()
+
+		# Further checks only poll the JSON API, and download only the media of new posts
+		httpretty.register_uri(httpretty.GET, 'http://a.4cdn.org/g/thread/39894014.json', body=read_file('testdata/4chan-api/39894014.json'))
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123.jpg', body='full image')
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123s.jpg', body='thumbnail')
+		downloader.download()
+
+		# Thumbnails are downloaded before full media
+		assert [r.path for r in httpretty.latest_requests()[-2:]] == ['/g/1390843500123s.jpg', '/g/1390843500123.jpg']
+
+	assert downloader.new_posts == 2
+
+	threaddir = savedir.join('boards.4chan.org', 'g', '39894014')
+	html = threaddir.join('39894014.html').read()
+	assert 'id="pc39894100"' in html
+	assert html.index('id="pc39894100"') < html.index('id="pc39894150"')
+	assert 'href="files/i.4cdn.org/g/1390843500123.jpg"' in html
+	assert threaddir.join('files', 'i.4cdn.org', 'g', '1390843500123s.jpg').read() == 'thumbnail'
+
+def test_4chan_api_update_parser_pool(tmpdir):
+	savedir = tmpdir.mkdir('savedir')
+
+	with chandl.ParserPool(1) as pool, HTTPrettify():
+		mock_thread('http://boards.4chan.org/g/thread/39894014', 'testdata/4chan-simple/39894014.html')
+		downloader = chandl.ThreadDownloader('http://boards.4chan.org/g/thread/39894014', str(savedir), None)
+		downloader.use_api = True
+		downloader.parser_pool = pool
+		downloader.download()
+
+		httpretty.register_uri(httpretty.GET, 'http://a.4cdn.org/g/thread/39894014.json', body=read_file('testdata/4chan-api/39894014.json'))
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123.jpg', body='full image')
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123s.jpg', body='thumbnail')
+		downloader.download()
+
+	# No parsed thread is kept in this process
+	assert downloader._parser == None
+	assert downloader.new_posts == 2
+
+	threaddir = savedir.join('boards.4chan.org', 'g', '39894014')
+	html = threaddir.join('39894014.html').read()
+	assert 'id="pc39894100"' in html
+	assert threaddir.join('files', 'i.4cdn.org', 'g', '1390843500123s.jpg').read() == 'thumbnail'
+	assert threaddir.listdir(lambda p: p.basename.endswith('.saving')) == []
+
+def test_low_memory(tmpdir):
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	savedir = tmpdir.mkdir('savedir')
+
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		downloader = chandl.ThreadDownloader(url, str(savedir), None)
+		downloader.use_api = True
+		downloader.low_memory = True
+		downloader.download()
+
+		parser = downloader._parser
+		assert parser._soup == None
+
+		# The thread is parsed again when new posts arrive, and released again once they have been merged
+		httpretty.register_uri(httpretty.GET, 'http://a.4cdn.org/g/thread/39894014.json', body=read_file('testdata/4chan-api/39894014.json'))
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123.jpg', body='full image')
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123s.jpg', body='thumbnail')
+		downloader.download()
+
+		assert downloader.new_posts == 2
+		assert parser._soup == None
+
+		# But not when there are none
+		parsed = []
+		parse_html = parser._parse_html
+		parser._parse_html = lambda html: parsed.append(html) or parse_html(html)
+		downloader.download()
+
+		assert downloader.new_posts == 0
+		assert parsed == []
+
+	html = savedir.join('boards.4chan.org', 'g', '39894014', '39894014.html').read()
+	assert html.index('id="pc39894100"') < html.index('id="pc39894150"')
+
+def test_html_parser_backends_identical():
+	pytest.importorskip('lxml')
+
+	from chandl.parser import LXMLBackend, HTML5LibBackend
+
+	html = read_file('testdata/4chan-simple/39894014.html.original')
+	lxml, html5lib = LXMLBackend(), HTML5LibBackend()
+
+	soup = lxml.parse(html)
+	assert lxml.accepts(html, soup)
+	assert str(soup) == str(html5lib.parse(html))
+
+def test_incremental_merge(tmpdir):
+	from chandl.fourchan import load_posts, render_posts
+
+	# Append the replies from the API test data to the thread page
+	original = read_file('testdata/4chan-simple/39894014.html.original').decode('utf-8')
+	i = original.index('</div><hr><div class="navLinks navLinksBot')
+	posts = load_posts('testdata/4chan-api/39894014.json')[1:]
+
+	# Non-ASCII text must come out the same, although the new posts are parsed apart from the page declaring its encoding
+	posts[0]['com'] = u'caf\xe9'
+	replies = render_posts('g', posts)
+
+	newpage = tmpdir.join('new.html')
+	newpage.write((original[:i] + replies + original[i:]).encode('utf-8'), mode='wb')
+
+	url = 'http://boards.4chan.org/g/thread/39894014'
+
+	incremental = chandl.ThreadParser(url, 'testdata/4chan-simple/39894014.html')
+	incremental.update(str(newpage))
+	incremental.save(str(tmpdir.join('incremental.html')))
+
+	# Merge the same page again, parsing all of it
+	full = chandl.ThreadParser(url, 'testdata/4chan-simple/39894014.html')
+	full._merge_incremental = lambda html: None
+	full.update(str(newpage))
+	full.save(str(tmpdir.join('full.html')))
+
+	assert incremental.new_post_count == 2
+	assert incremental.links_found == full.links_found
+	assert tmpdir.join('incremental.html').read('rb') == tmpdir.join('full.html').read('rb')
+	assert u'caf\xe9'.encode('utf-8') in tmpdir.join('incremental.html').read('rb')
+
+def test_chan_helper_index():
+	from bs4 import BeautifulSoup
+	from chandl.helpers import ChanHelper
+
+	def thread(*ids):
+		return BeautifulSoup(''.join('<div class="postContainer" id="pc{0:d}"></div>'.format(i) for i in ids).join(['<div class="thread">', '</div>']), 'html.parser')
+
+	helper = ChanHelper(thread(1, 2, 3))
+	newhelper = ChanHelper(thread(1, 2, 4, 5))
+
+	# Post 3 has been deleted from the new thread
+	assert helper.find_last_shared_post(newhelper) == 'pc2'
+
+	helper.insert_posts_after('pc3', newhelper.get_posts_after('pc2'))
+
+	assert helper.post_ids() == ['pc1', 'pc2', 'pc3', 'pc4', 'pc5']
+	assert helper.has_post('pc5')
+	assert [p['id'] for p in helper.get_thread().find_all('div')] == helper.post_ids()
+	assert [p['id'] for p in helper.get_posts_after('pc3')] == ['pc4', 'pc5']
+
+@pytest.mark.parametrize('honor_range', [True, False])
+def test_resume_download(tmpdir, honor_range):
+	import json
+	from chandl.downloader import download_file
+
+	url = 'http://i.4cdn.org/g/1390843500123.webm'
+	content = '0123456789abcdef'
+	saveto = str(tmpdir.join('file.webm'))
+
+	# Leave a partial download behind, along with its validator
+	tmpdir.join('file.webm.part').write(content[:6])
+	tmpdir.join('file.webm.part.info').write(json.dumps({'url' : url, 'etag' : '"abc"', 'last-modified' : None}))
+
+	def respond(request, uri, headers):
+		headers['etag'] = '"abc"'
+
+		if honor_range and request.headers.get('If-Range') == '"abc"':
+			start = int(request.headers['Range'][len('bytes='):].rstrip('-'))
+			headers['content-range'] = 'bytes {0:d}-{1:d}/{2:d}'.format(start, len(content) - 1, len(content))
+			return (206, headers, content[start:])
+
+		return (200, headers, content)
+
+	with HTTPrettify():
+		httpretty.register_uri(httpretty.GET, url, body=respond)
+		download_file(url, saveto, resume=True)
+
+		assert httpretty.last_request().headers['Range'] == 'bytes=6-'
+
+	assert tmpdir.join('file.webm').read() == content
+	assert not tmpdir.join('file.webm.part').check()
+	assert not tmpdir.join('file.webm.part.info').check()
+
+def test_media_store(tmpdir):
+	store = chandl.MediaStore(str(tmpdir.join('store')))
+	url = 'http://boards.4chan.org/g/thread/39894014'
+
+	def download(savedir, image):
+		with HTTPrettify():
+			mock_thread(url, 'testdata/4chan-simple/39894014.html')
+			downloader = chandl.ThreadDownloader(url, str(savedir), None)
+			downloader.use_api = True
+			downloader.store = store
+			downloader.download()
+
+			httpretty.register_uri(httpretty.GET, 'http://a.4cdn.org/g/thread/39894014.json', body=read_file('testdata/4chan-api/39894014.json'))
+			httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123.jpg', **image)
+			httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390843500123s.jpg', body='thumbnail')
+			downloader.download()
+
+		return savedir.join('boards.4chan.org', 'g', '39894014', 'files', 'i.4cdn.org', 'g', '1390843500123.jpg')
+
+	first = download(tmpdir.mkdir('first'), dict(body='full image'))
+
+	# The image should be linked from the store rather than downloaded, as its hash is in the page
+	second = download(tmpdir.mkdir('second'), dict(status=404, body=''))
+
+	assert second.read() == 'full image'
+	assert os.path.samefile(str(first), str(second))
+	assert os.path.samefile(str(second), store.path_for('aef5f7dd2f4a4b44ab2a8524fc8de590'))
+
+def test_download_manifest(tmpdir):
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	savedir = tmpdir.mkdir('savedir')
+	threaddir = savedir.join('boards.4chan.org', 'g', '39894014')
+	image = threaddir.join('files', 'i.4cdn.org', 'g', '1390842451744.png')
+	imagepath = 'files/i.4cdn.org/g/1390842451744.png'
+
+	download_4chan_simple(savedir)
+
+	manifest = chandl.DownloadManifest(str(threaddir.join('39894014.html.manifest')))
+	assert len(manifest) == 14
+	assert manifest.entries[imagepath] == (image.size(), '02d5756ac951f60de579ef65ba6f579e')
+
+	entries = dict(manifest.entries)
+	manifest.rebuild(str(threaddir))
+	assert manifest.entries == entries
+
+	# Leave a half-written image that is not in the manifest, and start the thread over
+	image.write(image.read()[:100])
+	threaddir.join('39894014.html').remove()
+	threaddir.join('39894014.html.original').remove()
+
+	lines = [l for l in threaddir.join('39894014.html.manifest').readlines() if imagepath not in l]
+	threaddir.join('39894014.html.manifest').write(''.join(lines))
+
+	# Only the image should be downloaded again
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		downloader = chandl.ThreadDownloader(url, str(savedir), None)
+		downloader.download()
+
+		assert [r.path for r in httpretty.latest_requests()] == ['/g/thread/39894014', '/g/1390842451744.png']
+
+	assert_identical(filecmp.dircmp(str(threaddir), 'testdata/4chan-simple'))
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_asset_cache(tmpdir, workers):
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	cache = chandl.AssetCache(str(tmpdir.join('assets')))
+
+	download_4chan_simple(tmpdir.mkdir('savedir'), asset_cache=cache, workers=workers)
+
+	# Only the site's own files are cached
+	assert len(cache.entries) == 12
+	assert all(u.startswith('http://s.4cdn.org/') for u in cache.entries)
+
+	def download(savedir):
+		with HTTPrettify():
+			mock_thread(url, 'testdata/4chan-simple/39894014.html')
+
+			downloader = chandl.ThreadDownloader(url, None, None)
+			downloader.set_destination(str(savedir), no_subdir=True)
+			downloader.asset_cache = cache
+			downloader.workers = workers
+			downloader.download()
+
+			return set(r.headers['host'] for r in httpretty.latest_requests())
+
+	# Another thread gets them from the cache, whatever the layout of its folder
+	savedir = tmpdir.mkdir('nosubdir')
+	assert 's.4cdn.org' not in download(savedir)
+	assert savedir.join('files', 's.4cdn.org', 'css', 'yotsubanew.560.css').read() == read_file('testdata/4chan-simple/files/s.4cdn.org/css/yotsubanew.560.css')
+	assert_identical(filecmp.dircmp(str(savedir), 'testdata/4chan-simple'))
+
+	# Once they are too old, they are checked again
+	cache.max_age = 0
+	assert 's.4cdn.org' in download(tmpdir.mkdir('stale'))
+
+	# The state of the cache is kept between runs
+	assert sorted(chandl.AssetCache(str(tmpdir.join('assets'))).entries) == sorted(cache.entries)
+
+def test_download_journal(tmpdir):
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	savedir = tmpdir.mkdir('savedir')
+	threaddir = savedir.join('boards.4chan.org', 'g', '39894014')
+
+	# Fail on the image, leaving it and anything queued after it pending
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		httpretty.register_uri(httpretty.GET, 'http://i.4cdn.org/g/1390842451744.png', status=500)
+		downloader = chandl.ThreadDownloader(url, str(savedir), None)
+
+		with pytest.raises(chandl.ThreadHTTPError):
+			downloader.download()
+
+	# The thread has been saved, and the pending downloads journaled
+	assert threaddir.join('39894014.html.original').check()
+	journal = chandl.DownloadJournal(str(threaddir.join('39894014.html.queue')))
+	assert 'files/i.4cdn.org/g/1390842451744.png' in journal
+
+	# After a restart, the pending downloads are finished before the thread is fetched again
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		downloader = chandl.ThreadDownloader(url, str(savedir), None)
+		downloader.download()
+
+		paths = [r.path for r in httpretty.latest_requests()]
+		assert '/g/1390842451744.png' in paths and paths[-1] == '/g/thread/39894014'
+		assert len(paths) == len(journal) + 1
+
+	assert not threaddir.join('39894014.html.queue').check()
+	assert_identical(filecmp.dircmp(str(threaddir), 'testdata/4chan-simple'))
+
+def test_download_journal_failing(tmpdir):
+	from chandl.fourchan import load_posts, render_posts
+
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	imageurl = 'http://i.4cdn.org/g/1390842451744.png'
+	savedir = tmpdir.mkdir('savedir')
+	threaddir = savedir.join('boards.4chan.org', 'g', '39894014')
+
+	# A reply without files is added to the thread after the first check
+	original = read_file('testdata/4chan-simple/39894014.html.original').decode('utf-8')
+	i = original.index('</div><hr><div class="navLinks navLinksBot')
+	newpage = original[:i] + render_posts('g', load_posts('testdata/4chan-api/39894014.json')[1:2]) + original[i:]
+
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		httpretty.register_uri(httpretty.GET, imageurl, status=500)
+		downloader = chandl.ThreadDownloader(url, str(savedir), None)
+
+		with pytest.raises(chandl.ThreadHTTPError):
+			downloader.download()
+
+	# The image keeps failing, but the thread is still updated, and the image is left queued for the next check
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		httpretty.register_uri(httpretty.GET, url, body=newpage.encode('utf-8'))
+		httpretty.register_uri(httpretty.GET, imageurl, status=500)
+		downloader.download()
+
+	assert downloader.new_posts == 1
+	assert 'pc39894100' in threaddir.join('39894014.html').read()
+	assert [u for u, saveto in downloader.download_queue] == [imageurl]
+	assert 'files/i.4cdn.org/g/1390842451744.png' in chandl.DownloadJournal(str(threaddir.join('39894014.html.queue')))
+
+	# Once it can be downloaded again, it is
+	with HTTPrettify():
+		mock_thread(url, 'testdata/4chan-simple/39894014.html')
+		httpretty.register_uri(httpretty.GET, url, body=newpage.encode('utf-8'))
+		downloader.download()
+
+	assert len(downloader.download_queue) == 0
+	assert not threaddir.join('39894014.html.queue').check()
+
+def test_validator_cache(tmpdir):
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	imageurl = 'http://i.4cdn.org/g/1390842451744.png'
+	savedir = tmpdir.mkdir('savedir')
+	image = savedir.join('boards.4chan.org', 'g', '39894014', 'files', 'i.4cdn.org', 'g', '1390842451744.png')
+
+	def etag_body(etag, body):
+		# Respond with an ETag and no Last-Modified, and with 304 if the client already has it
+		def respond(request, uri, headers):
+			headers['etag'] = etag
+
+			if request.headers.get('If-None-Match') == etag:
+				return 304, headers, ''
+
+			return 200, headers, body
+
+		return respond
+
+	def download(image_etag, image_body, force=False):
+		with HTTPrettify():
+			mock_thread(url, 'testdata/4chan-simple/39894014.html')
+			httpretty.register_uri(httpretty.GET, url, body=etag_body('W/"page"', read_file('testdata/4chan-simple/39894014.html.original')))
+			httpretty.register_uri(httpretty.GET, imageurl, body=etag_body(image_etag, image_body))
+
+			downloader = chandl.ThreadDownloader(url, str(savedir), None)
+			downloader.download(force=force)
+
+			return httpretty.latest_requests()
+
+	download('"image"', read_file('testdata/4chan-simple/files/i.4cdn.org/g/1390842451744.png'))
+
+	# A weak ETag is enough to get a 304 for the page
+	with pytest.raises(chandl.ThreadNotModified):
+		download('"image"', 'changed')
+
+	# When forced, the page is processed again without being downloaded, and only files with validators are revalidated
+	requests = download('"image"', 'changed', force=True)
+	assert [(r.path, r.headers.get('If-None-Match')) for r in requests] == [('/g/thread/39894014', 'W/"page"'), ('/g/1390842451744.png', '"image"')]
+	assert image.read() != 'changed'
+
+	# Files that have changed are downloaded again
+	download('"changed"', 'changed', force=True)
+	assert image.read() == 'changed'
+
+def test_atomic_write(tmpdir):
+	from chandl.utils import atomic_write
+
+	target = tmpdir.join('thread.html')
+	target.write('old')
+
+	# The old file is replaced in place, never removed first
+	removed = []
+	remove = os.remove
+	os.remove = lambda path: removed.append(path) or remove(path)
+	try:
+		atomic_write(str(target), ['new'])
+	finally:
+		os.remove = remove
+
+	assert target.read() == 'new'
+	assert removed == []
+	assert tmpdir.listdir() == [target]
+
+def test_incremental_save(tmpdir):
+	from chandl.fourchan import load_posts, render_posts
+
+	url = 'http://boards.4chan.org/g/thread/39894014'
+	replies = load_posts('testdata/4chan-api/39894014.json')[1:]
+
+	def save_updates(incremental):
+		threaddir = tmpdir.mkdir('incremental' if incremental else 'full')
+		saved = str(threaddir.join('39894014.html'))
+		threaddir.join('39894014.html').write(read_file('testdata/4chan-simple/39894014.html'), 'wb')
+
+		parser = chandl.ThreadParser(url, saved)
+		parser.incremental_save = incremental
+
+		# Merge and save the replies one at a time
+		for reply in replies:
+			parser.update_posts(render_posts('g', [reply]))
+			parser.save(saved)
+
+		return threaddir.join('39894014.html').read('rb')
+
+	incremental = save_updates(True)
+	assert 'id="pc39894150"' in incremental
+	assert incremental == save_updates(False)
+
+def test_catalog_watch():
+	import json
+	import time
+
+	class FakeWatch(object):
+		def __init__(self, url):
+			self.url = url
+
+		def next_check(self):
+			return time.time() + 60
+
+	def catalog(*threads):
+		return json.dumps([{'page': 1, 'threads': [dict(zip(('no', 'sub', 'replies', 'last_modified'), t)) for t in threads]}])
+
+	catalogs = [
+		catalog((1, 'Daily thread', 10, 100), (2, 'Other', 50, 100), (3, 'Daily thread', 1, 100)),
+		catalog((1, 'Daily thread', 11, 110), (3, 'Daily thread', 5, 110), (4, 'Daily thread', 20, 110)),
+	]
+
+	def respond(request, uri, headers):
+		if 'If-Modified-Since' in request.headers and len(catalogs) == 0:
+			return 304, headers, ''
+
+		headers['last-modified'] = 'Thu, 01 Jan 2015 00:00:00 GMT'
+		return 200, headers, catalogs.pop(0)
+
+	scheduler = chandl.Scheduler()
+	retired = []
+
+	with HTTPrettify():
+		httpretty.register_uri(httpretty.GET, 'http://a.4cdn.org/g/catalog.json', body=respond)
+
+		watch = chandl.CatalogWatch(chandl.BoardCatalog('http://boards.4chan.org/g/'), scheduler, FakeWatch, subject='^Daily', min_replies=5, retire_callback=retired.append)
+
+		# Only threads matching both filters are picked up
+		assert watch.check()
+		assert sorted(watch.watches) == [1]
+		assert scheduler.watches[0].url == 'http://boards.4chan.org/g/thread/1'
+
+		# New threads are added and threads that now match are picked up, while changed threads are checked right away
+		assert watch.check()
+		assert sorted(watch.watches) == [1, 3, 4]
+		assert scheduler.watches[0] is watch.watches[1]
+
+		# The catalog is only downloaded again if it has been modified
+		assert watch.check()
+		assert httpretty.last_request().headers['If-Modified-Since'] == 'Thu, 01 Jan 2015 00:00:00 GMT'
+
+		# Threads that fall off the catalog or have stopped by themselves are retired, and never picked up again
+		fallen, stopped = watch.watches[1], watch.watches[3]
+		catalogs.append(catalog((3, 'Daily thread', 6, 120), (4, 'Daily thread', 21, 120)))
+		scheduler.remove(stopped)
+		assert watch.check()
+		assert retired == [stopped, fallen]
+		assert sorted(watch.watches) == [4]
+		assert scheduler.watches == [watch.watches[4]]